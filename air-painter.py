@@ -9,14 +9,16 @@ x = 0
 y = 0
 z = 0 
 
-@skywriter.move()
-def move(xa,ya,za):
-      #print(x,y,z)
+def sample():
+  # Predict where the hand will be once this frame's sleep is over
   global x,y,z
+  xa, ya, za = skywriter.predict(time.time() + 0.02)
   x = xa * 255
   y = 255 - (ya  * 255)
   z = za  * 255
- 
+
+skywriter.start()
+
 
 pygame.init()
 screen = pygame.display.set_mode((600, 600))
@@ -59,6 +61,7 @@ def main():
     if ev.type == pygame.QUIT:  # Window close button clicked?
       break
     #sometext('test')#   ... leave game loop
+    sample()
     Backsquare((z,z))
     #pygame.display.flip()
     pygame.display.update()
@@ -0,0 +1,119 @@
+'''
+Decoder microbenchmark
+
+Feeds sensor frames from the simulated MGC3130 through the
+original list.pop(0) decoder and through skywriter.handle_message,
+then prints decoded frames per second for each.
+
+Run from the repository root:
+
+  python benchmarks/decode.py [frames | capture file]
+
+Given a capture made with skywriter.start_capture(), its
+recorded messages are decoded instead, for a deterministic run
+against real sensor traffic.
+'''
+import os, sys, time
+
+os.environ['SKYWRITER_BACKEND'] = 'sim'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import skywriter
+
+skywriter.autostart = False
+# Call handlers inline, as the legacy decoder does
+skywriter.threaded_dispatch = False
+
+def legacy_decode(data):
+  '''
+  The decoder as it was before handle_message, kept for comparison
+  '''
+  d_size  = data.pop(0)
+  d_flags = data.pop(0)
+  d_seq   = data.pop(0)
+  d_ident = data.pop(0)
+
+  d_configmask = data.pop(0) | data.pop(0) << 8
+  d_timestamp  = data.pop(0)
+  d_sysinfo    = data.pop(0)
+
+  d_dspstatus = data[0:2]
+  d_gesture   = data[2:6]
+  d_touch     = data[6:10]
+  d_airwheel  = data[10:12]
+  d_xyz       = data[12:20]
+  d_noisepow  = data[20:24]
+
+  if d_configmask & skywriter.SW_DATA_XYZ and d_sysinfo & 0b0000001:
+    x, y, z = (
+      (d_xyz[1] << 8 | d_xyz[0]) / 65536.0,
+      (d_xyz[3] << 8 | d_xyz[2]) / 65536.0,
+      (d_xyz[5] << 8 | d_xyz[4]) / 65536.0
+    )
+    _on_move(x, y, z)
+
+  if d_configmask & skywriter.SW_DATA_GESTURE and not d_gesture[0] == 0:
+    gestures = [
+      ('garbage','',''),
+      ('flick','west','east'),
+      ('flick','east','west'),
+      ('flick','south','north'),
+      ('flick','north','south'),
+      ('circle','clockwise',''),
+      ('circle','counter-clockwise','')
+    ]
+    for i,gesture in enumerate(gestures):
+      if d_gesture[0] == i + 1:
+        break
+
+  if d_configmask & skywriter.SW_DATA_TOUCH:
+    d_action = d_touch[1] << 8 | d_touch[0]
+    actions = [
+      ('touch','south'), ('touch','west'), ('touch','north'), ('touch','east'), ('touch','center'),
+      ('tap','south'), ('tap','west'), ('tap','north'), ('tap','east'), ('tap','center'),
+      ('doubletap','south'), ('doubletap','west'), ('doubletap','north'), ('doubletap','east'), ('doubletap','center')
+    ]
+    comp = 0b0000000000000001 << len(actions)-1
+    for action in reversed(actions):
+      if d_action & comp:
+        break
+      comp = comp >> 1
+
+def _on_move(x, y, z):
+  pass
+
+def run(decode, frames):
+  start = time.time()
+  for frame in frames:
+    decode(list(frame))
+  return len(frames) / (time.time() - start)
+
+def main():
+  source = sys.argv[1] if len(sys.argv) > 1 else '200000'
+
+  skywriter.move()(_on_move)
+
+  if os.path.isfile(source):
+    capture = skywriter.CaptureFile(source)
+    frames = [capture[i][1] for i in range(len(capture))]
+    frames = [frame for frame in frames if frame[3] == skywriter.SW_SENSOR_DATA]
+    capture.close()
+  else:
+    sim = skywriter.SimulatedMGC3130(rate=0, seed=1, gesture_every=50, touch_every=30)
+    frames = [sim.read_i2c_block_data(skywriter.SW_ADDR, 0x00, 26) for i in range(int(source))]
+  count = len(frames)
+
+  '''
+  Both decoders are handed a fresh copy of each frame, matching
+  the new list SMBus returns on every read
+  '''
+  legacy = run(legacy_decode, frames)
+  current = run(skywriter.default_device().handle_message, frames)
+
+  print('frames:            %d' % count)
+  print('legacy decoder:    %.0f frames/s' % legacy)
+  print('handle_message:    %.0f frames/s' % current)
+  print('speedup:           %.2fx' % (current / legacy))
+
+if __name__ == '__main__':
+  main()
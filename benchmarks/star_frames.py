@@ -0,0 +1,93 @@
+'''
+Star-lines frame benchmark
+
+Runs the star-field for a number of frames at a range of star
+counts in each of these modes, and reports the time and the peak
+memory allocated per frame:
+
+  alloc   every frame's arrays allocated afresh
+  ws      the preallocated workspace
+  packed  the workspace with the packed float32 star-field
+
+alloc and ws are checked to draw exactly the same pixels; packed
+stars are float32, so their pixels differ slightly.
+
+Run from the repository root:
+
+  python benchmarks/star_frames.py [star counts ...]
+
+Counts default to a sweep from 2k to 200k stars; a million-star
+field takes a while but runs. No window is opened; frames are
+drawn to an off-screen 8-bit surface.
+'''
+import os, sys, time, hashlib
+
+os.environ['SKYWRITER_BACKEND'] = 'sim'
+os.environ['SDL_VIDEODRIVER'] = 'dummy'
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'star-lines-0.4'))
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+import numpy as np
+import main
+
+WIDTH, HEIGHT = 640, 480
+FRAMES = 60
+MODES = (
+  ('alloc', dict(workspace=False)),
+  ('ws', dict(workspace=True)),
+  ('packed', dict(workspace=True, packed=True)),
+)
+
+# Hand Main an off-screen surface in place of the window, as the
+# dummy video driver has no 8-bit palette modes.
+main.pg.display.set_mode = lambda size, flags, depth: main.pg.Surface(size, flags, depth)
+
+def run(count, lines, yaw, options):
+  '''
+  FRAMES frames of count stars from the same random start, giving
+  the seconds and peak bytes allocated per frame and a digest of
+  every frame's pixels
+  '''
+  np.random.seed(1)
+  program = main.Main(WIDTH, HEIGHT, 0, 8, main.DrawPixels, count, lines, **options)
+  program.roll_ang, program.yaw_ang = 0.4, yaw
+  frame = program.FrameInPlace if options['workspace'] else program.Frame
+  pixels = hashlib.sha1()
+  # Settle the workspace and the old line positions first.
+  for a in frame(0.02):
+    pixels.update(a.tobytes())
+
+  elapsed = peak = 0
+  for i in range(FRAMES):
+    if tracemalloc:
+      tracemalloc.start()
+    start = time.time()
+    drawn = frame(0.02)
+    elapsed += time.time() - start
+    if tracemalloc:
+      peak += tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+    for a in drawn:
+      pixels.update(a.tobytes())
+  return elapsed / FRAMES, peak // FRAMES, pixels.hexdigest()
+
+def main_():
+  counts = [int(n) for n in sys.argv[1:]] or [2000, 5000, 10000, 20000, 50000, 100000, 200000]
+
+  names = [name for name, options in MODES]
+  print('%8s %7s ' % ('stars', 'lines') + ' '.join('%9s' % (name + ' ms') for name in names) +
+        ' ' + ' '.join('%9s' % (name + ' KB') for name in names) + ' identical')
+  for count in counts:
+    for lines, yaw in ((False, 0.3), (True, 0.3), (True, 2.0)):
+      results = [run(count, lines, yaw, options) for name, options in MODES]
+      print('%8d %7s ' % (count, 'yaw %.1f' % yaw if lines else 'no') +
+            ' '.join('%9.2f' % (r[0] * 1000) for r in results) + ' ' +
+            ' '.join('%9d' % (r[1] // 1024) for r in results) + ' %s' % (results[0][2] == results[1][2]))
+
+if __name__ == '__main__':
+  main_()
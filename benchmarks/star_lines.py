@@ -0,0 +1,85 @@
+'''
+Star-lines line rasterizer benchmark
+
+Builds a frame's worth of star streaks for a range of star
+counts and times the original per-star ExtendLines loop against
+the vectorized ExtendLines in star-lines-0.4/main.py, checking
+both produce exactly the same pixels.
+
+Run from the repository root:
+
+  python benchmarks/star_lines.py [star counts ...]
+
+Counts default to a sweep from 2k to 200k stars.
+'''
+import os, sys, time
+
+os.environ['SKYWRITER_BACKEND'] = 'sim'
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'star-lines-0.4'))
+
+import numpy as np
+import main
+
+WIDTH, HEIGHT = 640, 480
+MAX_LEN = WIDTH // 10
+
+def legacy_extend_lines(x, y, ox, oy, b, max_len):
+  '''
+  Main.ExtendLines as it was before vectorizing, kept for comparison
+  '''
+  abs_dx = abs(ox - x).astype(int) + 1
+  abs_dy = abs(oy - y).astype(int) + 1
+  abs_max_d = np.maximum(abs_dx, abs_dy)
+  sizes = np.minimum(max_len, abs_max_d)
+  ret_x, ret_y, ret_b = (np.zeros(np.sum(sizes)) for q in range(3))
+
+  i = 0
+  for q in range(sizes.size):
+    cap = sizes[q]
+    s = slice(i, i + cap)
+    ret_x[s] = np.linspace(x[q], ox[q], abs_max_d[q], True)[: cap]
+    ret_y[s] = np.linspace(y[q], oy[q], abs_max_d[q], True)[: cap]
+    ret_b[s] = np.zeros(cap) + b[q]
+    i += cap
+
+  return ret_x, ret_y, ret_b
+
+def streaks(count, seed=1):
+  '''
+  count stars on screen, each moved up to MAX_LEN * 1.5 pixels
+  since the previous frame, as ExtendLines is handed them
+  '''
+  rng = np.random.RandomState(seed)
+  x = rng.uniform(2, WIDTH - 2, count)
+  y = rng.uniform(2, HEIGHT - 2, count)
+  length = 3.0 + rng.exponential(MAX_LEN / 4.0, count)
+  angle = rng.uniform(0, 2 * np.pi, count)
+  ox = np.clip(x + np.cos(angle) * length, 2, WIDTH - 2)
+  oy = np.clip(y + np.sin(angle) * length, 2, HEIGHT - 2)
+  b = rng.uniform(0, 1, count)
+  return x, y, ox, oy, b
+
+def best(func, args, repeat):
+  times = []
+  for i in range(repeat):
+    start = time.time()
+    result = func(*args)
+    times.append(time.time() - start)
+  return min(times), result
+
+def main_():
+  counts = [int(n) for n in sys.argv[1:]] or [2000, 5000, 10000, 20000, 50000, 100000, 200000]
+
+  print('%8s %10s %12s %12s %9s %s' % ('stars', 'pixels', 'legacy ms', 'vector ms', 'speedup', 'identical'))
+  for count in counts:
+    args = streaks(count) + (MAX_LEN,)
+    legacy_time, legacy = best(legacy_extend_lines, args, 1)
+    vector_time, vector = best(main.ExtendLines, args, 5)
+    identical = all(np.array_equal(a, b) for a, b in zip(legacy, vector))
+    print('%8d %10d %12.1f %12.1f %8.1fx %s' % (
+      count, vector[0].size, legacy_time * 1000, vector_time * 1000,
+      legacy_time / vector_time, identical))
+
+if __name__ == '__main__':
+  main_()
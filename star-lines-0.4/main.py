@@ -24,25 +24,19 @@ from numpy.random import rand, randint
 from time import time
 
 from primitives import DrawPixels, DrawPixelQuads
-skyx = 0
-skyy = 0
-skyz = 0
-
-@skywriter.move()
-def move(xa,ya,za):
-  #print(x,y,z)
-  global skyx,skyy,skyz
-  skyx =  10 - xa * 20
-  skyy =  10 - ya * 20
-  skyz = za * 255
 
 class Starfield (object):
     """
     Sets values for arrays of star information based on given
     constraints.
+
+    The star arrays are rows of one contiguous block, with the x, y
+    and z rows together as xyz. With packed set the block is
+    float32, and Partition() can keep it ordered so that stars
+    ahead of the camera are a slice from the start of every array.
     """
 
-    def __init__(self, width, height, min_z, max_z, n_stars):
+    def __init__(self, width, height, min_z, max_z, n_stars, packed=False):
         """ Initialize constraints and arrays. """
 
         # Set star-field constraints as given through function arguments.
@@ -52,10 +46,17 @@ class Starfield (object):
         self.min_y, self.max_y = -float(self.h / 2), float(self.h / 2)
         self.min_z, self.max_z = float(min_z), float(max_z)
 
-        # Initialize four velocity/position arrays to correct size,
+        # Initialize five velocity/position arrays to correct size,
         # filled with zeros (floating points).
-        for ary_name in ('vel_ary', 'x_ary', 'y_ary', 'z_ary'):
-            setattr(self, ary_name, np.zeros(n_stars, dtype=float))
+        self.packed = packed
+        self.dtype = np.float32 if packed else float
+        ary_names = ('vel_ary', 'vel_sqrt_ary', 'x_ary', 'y_ary', 'z_ary')
+        self.block = np.zeros((len(ary_names), n_stars), self.dtype)
+        for ary_name, row in zip(ary_names, self.block):
+            setattr(self, ary_name, row)
+        self.xyz = self.block[2:]
+        # Reused each frame to find the stars that have gone past.
+        self.past_ary = np.zeros(n_stars, dtype=bool)
 
         # Make sure all elements of z_ary are beyond sight so that the
         # whole array is initialized to random values in the call to
@@ -73,14 +74,14 @@ class Starfield (object):
             indices = np.arange(size)
         else:
             # Get array indices of all cases where z_ary < min_z.
-            indices = np.nonzero(self.z_ary < self.min_z)
-            size = indices[0].size
+            np.less(self.z_ary, self.min_z, out=self.past_ary)
+            indices = np.flatnonzero(self.past_ary)
+            size = indices.size
         # Set x, y, and z arrays as well as star velocities to
         # constrained random values.
         self.vel_ary[indices] = (0.1 + 9.9 * rand(size)) ** -1.5
-        if size > 0:
-            # Update velocity square-root values if needed.
-            self.vel_sqrt_ary = np.sqrt(self.vel_ary)
+        # Update velocity square-root values of the reset stars.
+        self.vel_sqrt_ary[indices] = np.sqrt(self.vel_ary[indices])
         self.x_ary[indices] = self.min_x + rand(size) * self.w
         self.y_ary[indices] = self.min_y + rand(size) * self.h
         if reset_all == True:
@@ -96,26 +97,243 @@ class Starfield (object):
         return indices
 
 
-    def RotateX(self, x_amt):
+    def Move(self, dist, tmp=None):
+        """
+        Move the camera dist forward, so stars come dist nearer
+        scaled by the relative velocity of each. tmp is an array to
+        use as scratch space, if given.
         """
-        Calculate and set roll rotation.
 
-        x_amt is angle in radians to rotate stars.
+        if tmp is None:
+            self.z_ary -= dist * self.vel_ary
+        else:
+            self.z_ary -= np.multiply(self.vel_ary, dist, out=tmp)
+
+
+    def Partition(self, ahead, *arys):
+        """
+        Reorder a packed star-field so stars where boolean array
+        ahead is true come first, and return how many there are.
+
+        Only stars on the wrong side of the new boundary are moved,
+        so a frame costs little more than a scan of ahead. Arrays
+        in arys, one star per element along their last axis, are
+        reordered alongside the stars. ahead itself is used as
+        scratch space and left overwritten.
         """
 
-        # numpy's universal functions are helpful in making these
-        # calculations go smoothly.
-        tan2_ary = np.arctan2(self.y_ary, self.x_ary)
-        dist_ary = np.hypot(self.x_ary, self.y_ary)
-        angle_inc = x_amt / 256.0
-        self.x_ary = dist_ary * np.cos(tan2_ary + angle_inc)
-        self.y_ary = dist_ary * np.sin(tan2_ary + angle_inc)
+        n = np.count_nonzero(ahead)
+        # Stars behind the camera within the first n, and stars
+        # ahead of it after them, swap places.
+        np.logical_not(ahead[:n], out=ahead[:n])
+        to_back = np.flatnonzero(ahead[:n])
+        to_front = np.flatnonzero(ahead[n:]) + n
+        src = np.concatenate((to_back, to_front))
+        dst = np.concatenate((to_front, to_back))
+        for ary in (self.block,) + arys:
+            ary[..., dst] = ary[..., src]
+        return n
+
+
+def ExtendLines(x, y, ox, oy, b, max_len):
+    """
+    Calculate and return pixels of extended lines based on given
+    arrays.
+
+    x, y: New arrays of screen x/y coordinates.
+    ox, oy: Old arrays. Lines will be attempted from x/y to ox/oy.
+    b: Brightness level of each coord.
+    max_len: Longest line, in pixels, drawn for any one star.
+
+    Every line is rasterized at once: each line gets a run of
+    output slots, and each slot knows its line and its step along
+    it, so there is no Python loop over stars. The pixels are the
+    same as np.linspace(x, ox, n)[:max_len] would give per star.
+    """
+
+    # Get absolute difference between old and new arrays.
+    abs_dx = abs(ox - x).astype(int) + 1
+    abs_dy = abs(oy - y).astype(int) + 1
+    # Get maximum of previous two arrays at each element.
+    abs_max_d = np.maximum(abs_dx, abs_dy)
+    # Cap maximums to a safe value, to conserve computer time and
+    # memory, and not be overly sluggish; this limits the length of
+    # each star line, though.
+    sizes = np.minimum(int(max_len), abs_max_d)
+
+    # Offset of each line's first pixel in the return arrays, then
+    # for every pixel the line it belongs to and its step along it.
+    ends = np.cumsum(sizes)
+    line = np.repeat(np.arange(sizes.size), sizes)
+    k = np.arange(ends[-1] if sizes.size else 0) - np.repeat(ends - sizes, sizes)
+
+    # Interpolate as np.linspace does, start + k * step, with the
+    # end point set exactly where a line is drawn in full.
+    div = np.maximum(abs_max_d - 1, 1)
+    ret_x = k * ((ox - x) / div)[line] + x[line]
+    ret_y = k * ((oy - y) / div)[line] + y[line]
+    full = np.nonzero(np.logical_and(sizes == abs_max_d, abs_max_d > 1))
+    ret_x[ends[full] - 1] = ox[full]
+    ret_y[ends[full] - 1] = oy[full]
+    # Brightness level of each line is uniform.
+    ret_b = b[line]
+
+    return ret_x, ret_y, ret_b
+
+
+def InBounds(out, tmp, x, y, min_x, max_x, min_y, max_y):
+    """
+    Set boolean array out to where min_x < x < max_x and
+    min_y < y < max_y, using tmp as scratch space. Returns out.
+    """
+
+    np.greater(x, min_x, out=out)
+    np.less(x, max_x, out=tmp)
+    out &= tmp
+    np.greater(y, min_y, out=tmp)
+    out &= tmp
+    np.less(y, max_y, out=tmp)
+    out &= tmp
+    return out
+
+
+def Take(src, indices, out):
+    """
+    Gather src at indices into the front of out and return that
+    view. np.compress() would allocate twice per call; with
+    mode='clip' take() writes straight into out, and the indices
+    are always in range here. indices can also be a slice from the
+    start, as for a packed Starfield.
+    """
+
+    if isinstance(indices, slice):
+        out = out[indices]
+        out[...] = src[indices]
+        return out
+    return np.take(src, indices, out=out[:indices.size], mode='clip')
+
+
+class Workspace (object):
+    """
+    Preallocated per-frame arrays for Main.FrameInPlace().
+
+    Star arrays are sized to the star count. Pixel and line arrays
+    start at the same size and grow to hold star-lines as needed,
+    and are then kept, so steady-state frames allocate close to
+    nothing.
+    """
+
+    def __init__(self, n_stars, dtype=float):
+        """ Allocate all star, line and pixel arrays. """
+
+        self.dtype = dtype
+        for ary_name in ('copy_z', 'tmp', 'px', 'py', 'pz',
+                         'x', 'y', 'b', 'ox', 'oy',
+                         'lx', 'ly', 'lox', 'loy', 'lb', 'ldx', 'ldy'):
+            setattr(self, ary_name, np.zeros(n_stars, dtype))
+        # Star positions turned to face the camera.
+        self.rot = np.zeros((3, n_stars), dtype)
+        self.rx, self.ry, self.rz = self.rot
+        for ary_name in ('prep', 'mask_a', 'mask_b', 'mask_c',
+                         'full', 'full_tmp'):
+            setattr(self, ary_name, np.zeros(n_stars, dtype=bool))
+        # Per-line lengths and offsets, and steps and end points in
+        # float64, as ExtendLines() works them out.
+        for ary_name in ('len_x', 'len_y', 'len_max', 'sizes', 'ends',
+                         'starts'):
+            setattr(self, ary_name, np.zeros(n_stars, dtype=int))
+        for ary_name in ('step', 'end', 'start'):
+            setattr(self, ary_name, np.zeros(n_stars))
+        self.size = self.line_size = 0
+        self.Reserve(n_stars)
+        self.ReserveLines(n_stars)
+
+
+    def Reserve(self, size):
+        """ Make sure the pixel arrays hold at least size pixels. """
+
+        if size <= self.size:
+            return
+        # Grow by at least half again, to settle in a few frames.
+        self.size = max(size, self.size * 3 // 2)
+        for ary_name in ('ax', 'ay', 'ab', 'dx', 'dy', 'db'):
+            setattr(self, ary_name, np.zeros(self.size, self.dtype))
+        for ary_name in ('draw', 'draw_tmp'):
+            setattr(self, ary_name, np.zeros(self.size, dtype=bool))
+
+
+    def ReserveLines(self, size):
+        """ Make sure the line arrays hold at least size pixels. """
+
+        if size <= self.line_size:
+            return
+        self.line_size = max(size, self.line_size * 3 // 2)
+        for ary_name in ('line_x', 'line_y', 'line_t'):
+            setattr(self, ary_name, np.zeros(self.line_size))
+        self.line_b = np.zeros(self.line_size, self.dtype)
+        self.line = np.zeros(self.line_size, dtype=int)
+        self.line_k = np.zeros(self.line_size, dtype=int)
+        self.count = np.arange(self.line_size)
+
+
+    def ExtendLines(self, x, y, ox, oy, b, max_len):
+        """
+        Same as ExtendLines() at module level, worked out in this
+        workspace's arrays, and to exactly the same pixels. The
+        returned arrays are only good until the next call.
+        """
+
+        n = x.size
+        sizes, ends = self.sizes[:n], self.ends[:n]
+        dx = np.subtract(ox, x, out=self.ldx[:n])
+        dy = np.subtract(oy, y, out=self.ldy[:n])
+        # As abs(ox - x).astype(int) + 1, and the same for y.
+        abs_dx = np.absolute(dx, out=self.len_x[:n], casting='unsafe')
+        abs_dx += 1
+        abs_dy = np.absolute(dy, out=self.len_y[:n], casting='unsafe')
+        abs_dy += 1
+        abs_max_d = np.maximum(abs_dx, abs_dy, out=self.len_max[:n])
+        np.minimum(abs_max_d, int(max_len), out=sizes)
+        np.cumsum(sizes, out=ends)
+        total = int(ends[-1]) if n else 0
+        self.ReserveLines(total)
+
+        # Every line has a pixel at least, so marking where each one
+        # starts and summing the marks gives each pixel its line.
+        line = self.line[:total]
+        line.fill(0)
+        line[ends[:-1]] = 1
+        np.cumsum(line, out=line)
+        starts = np.subtract(ends, sizes, out=self.starts[:n])
+        k = np.take(starts, line, out=self.line_k[:total], mode='clip')
+        np.subtract(self.count[:total], k, out=k)
+
+        div = np.subtract(abs_max_d, 1, out=self.len_x[:n])
+        np.maximum(div, 1, out=div)
+        full = np.equal(sizes, abs_max_d, out=self.full[:n])
+        full &= np.greater(abs_max_d, 1, out=self.full_tmp[:n])
+        last = np.subtract(ends, 1, out=self.starts[:n])
+        for d, start, stop, ret in ((dx, x, ox, self.line_x),
+                                    (dy, y, oy, self.line_y)):
+            ret = np.take(np.divide(d, div, out=self.step[:n]), line,
+                          out=ret[:total], mode='clip')
+            ret *= k
+            np.copyto(self.start[:n], start)
+            ret += np.take(self.start[:n], line, out=self.line_t[:total],
+                           mode='clip')
+            end = np.take(ret, last, out=self.end[:n], mode='clip')
+            np.copyto(end, stop, where=full)
+            ret[last] = end
+        ret_b = np.take(b, line, out=self.line_b[:total], mode='clip')
+
+        return self.line_x[:total], self.line_y[:total], ret_b
 
 
 class Main:
     """ Main program lies here. """
 
-    def __init__(self, width, height, flags, depth, method, n_stars, effect):
+    def __init__(self, width, height, flags, depth, method, n_stars, effect,
+                 workspace=True, packed=False):
         """ Initialize display and prepare for main loop. """
 
         self.w, self.h = width, height
@@ -124,6 +342,12 @@ class Main:
         self.method = method
         self.n_stars = n_stars
         self.show_star_lines = effect
+        # Start the sensor first so its reset overlaps display setup.
+        skywriter.start()
+        # Begin recording sensor frames for per-frame batches, and
+        # smooth them to take the jitter out of the camera.
+        skywriter.drain()
+        self.sky_filter = skywriter.OneEuroFilter()
         os.environ['SDL_VIDEO_CENTERED'] = '1'
         pg.display.init()
         self.screen = pg.display.set_mode((self.w, self.h),flags,self.bpp)
@@ -139,18 +363,25 @@ class Main:
         self.screen.set_palette(self.pal)
 
         z = 4.0 * self.h
-        self.s = Starfield(self.w, self.w, -z, z, n_stars)
+        self.s = Starfield(self.w, self.w, -z, z, n_stars, packed)
         # Old x/y arrays of values for drawing star-lines.
         # Set to infinite amounts at first to draw stars and not lines
         # until one frame has passed.
-        self.old_x = np.zeros(self.n_stars, dtype=float) + np.inf
-        self.old_y = np.zeros(self.n_stars, dtype=float) + np.inf
+        self.old_x = np.zeros(self.n_stars, self.s.dtype) + np.inf
+        self.old_y = np.zeros(self.n_stars, self.s.dtype) + np.inf
         self.zoom = self.cx * 1.5
         self.cam_speed = 240.0
         self.max_star_len = self.w / 10
         self.mxr = 0
         self.myr = 0
+        self.roll_ang = 0.0
         self.yaw_ang = 0.0
+        # Preallocated arrays for each frame, or None to allocate them
+        # afresh every frame.
+        if workspace:
+            self.ws = Workspace(n_stars, self.s.dtype)
+        else:
+            self.ws = None
 
         self.frames = 0
 
@@ -165,94 +396,32 @@ class Main:
 
     def Run(self):
         """ Main control loop. """
-        global skyx,skyy,skyz
         while True:
-            skyx =- 0.1 
-            skyy =- 0.1
-            if(skyx <  0):
-              skyx = 0
-            if(skyy <  0):
-              skyy = 0
+            # Filter every valid position the sensor delivered since
+            # the last frame and steer with the newest. With none, the
+            # camera is not steered.
+            batch = self.sky_filter.apply(skywriter.drain())
+            if batch.size > 0:
+                skyx = 10 - batch['x'][-1] * 20
+                skyy = 10 - batch['y'][-1] * 20
+                skyz = batch['z'][-1] * 255
+            else:
+                skyx = skyy = skyz = 0
 
             self.cam_speed = 200 + (255 - skyz)
-            skyz = 0
             # Start with a blank screen each frame.
             self.screen.fill(0)
 
             # t is the time taken since the last frame, and won't go
             # above approximately 40 milliseconds.
             t = min(0.04, time() - self.ticks)
-            copy_z = np.copy(self.s.z_ary)
-            # Change the distance of each star from camera based on
-            # speed, time past, and the relative velocity of each star.
-            self.s.z_ary -= self.cam_speed * t * self.s.vel_ary
-            self.ticks = time()
-
-            # Reset all stars that have "disappeared". If star-lines are
-            # being drawn, the old x/y values at these indices are
-            # reset, to keep lines from being drawn for one frame
-            # (prevents a major slowdown).
-            indices = self.s.ResetPastStars()
-            if self.show_star_lines:
-                self.old_x[indices] = self.old_y[indices] = np.inf
-
-            # Calculate rotated coord arrays based on camera yaw angle.
-            cos_ang, sin_ang = np.cos(self.yaw_ang), np.sin(self.yaw_ang)
-            rx_ary = self.s.x_ary
-            ry_ary = self.s.y_ary * cos_ang + self.s.z_ary * sin_ang
-            rz_ary = self.s.z_ary * cos_ang - self.s.y_ary * sin_ang
-
-            # Draw stars that appear ahead of the camera.
-            prep = rz_ary > 0.0
-            rx, ry, rz = rx_ary[prep], ry_ary[prep], rz_ary[prep]
-            # Get x and y screen coordinates.
-            x = self.cx + rx / rz * self.zoom
-            y = self.cy + ry / rz * self.zoom
-            # Get bright amount for visible stars.
-            # Multiply by the square-root of the relative star velocity
-            # for a nice depth-effect.
-            b = (2.0 - rz / self.w) * self.s.vel_sqrt_ary[prep]
-
-            if self.show_star_lines:
-                # Find stars that are crossing front to back.
-                diff = np.logical_and(self.s.z_ary <= 0.0, copy_z > 0.0)
-                ox, oy = self.old_x[prep], self.old_y[prep]
-                # Set old screen coords to current coords here.
-                self.old_x[prep] = x
-                self.old_y[prep] = y
-                if np.pi / 2.0 < self.yaw_ang < np.pi * 7.0 / 6.0:
-                    # A fix for a weird effect that makes the lines draw
-                    # incorrectly if the camera angle is pointed
-                    # backward a certain amount.
-                    x[diff[prep]] = -x[diff[prep]]
-                    y[diff[prep]] = -y[diff[prep]]
-                    ox[diff[prep]] = -ox[diff[prep]]
-                    oy[diff[prep]] = -oy[diff[prep]]
-                # Make sure old x/y screen coords are within screen.
-                x_in = np.logical_and(ox > 1, ox < self.w - 1)
-                y_in = np.logical_and(oy > 1, oy < self.h - 1)
-                inside = np.logical_and(x_in, y_in)
-                # Test if x or y coords are different enough to justify
-                # drawing a line.
-                test = np.logical_or(abs(x - ox) > 2.0, abs(y - oy) > 2.0)
-                a = np.nonzero(np.logical_and(inside, test))
-                # Get the line pixels and add them to the arrays of star
-                # pixels to draw.
-                lines = self.ExtendLines(x[a], y[a], ox[a], oy[a], b[a])
-                ax = np.concatenate((x[inside], lines[0]))
-                ay = np.concatenate((y[inside], lines[1]))
-                ab = np.concatenate((b[inside], lines[2]))
+            if self.ws is None:
+                ax, ay, ab = self.Frame(t)
             else:
-                ax = x
-                ay = y
-                ab = b
-
-            x_in = np.logical_and(ax > 1, ax < self.w - 2)
-            y_in = np.logical_and(ay > 1, ay < self.h - 2)
-            draw = np.nonzero(np.logical_and(x_in, y_in))
+                ax, ay, ab = self.FrameInPlace(t)
 
             # Call appropriate draw method on screen with given arrays.
-            self.method(self.screen, ax[draw], ay[draw], ab[draw])
+            self.method(self.screen, ax, ay, ab)
             pg.display.update()
             self.frames += 1
 
@@ -261,10 +430,12 @@ class Main:
             if self.show_star_lines and self.mxr != 0 or self.myr != 0:
                 # If rotating camera, stop drawing lines for a frame.
                 self.old_x[...] = self.old_y[...] = np.inf
-            if self.mxr != 0:
-                self.s.RotateX(-self.mxr)
+            # Roll and yaw the camera. Stars stay where they are, and
+            # are turned to face the camera as they are projected.
+            self.roll_ang -= self.mxr / 256.0
             self.yaw_ang -= self.myr * 0.01
-            # Keep yaw angle between 0 and 2 * pi radians
+            # Keep angles between 0 and 2 * pi radians
+            self.roll_ang %= 2.0 * np.pi
             self.yaw_ang %= 2.0 * np.pi
 
             # Left and right mouse buttons speed up and slow down camera
@@ -291,44 +462,198 @@ class Main:
                 elif evt.type == pg.MOUSEBUTTONDOWN:
                     exit()
                     if evt.button == 2:
-                        print self.yaw_ang
+                        print(self.yaw_ang)
+
+
+    def Frame(self, t):
+        """
+        Move stars on by t seconds and return x, y and brightness
+        arrays of the pixels to draw.
+        """
+
+        copy_z = np.copy(self.s.z_ary)
+        # Change the distance of each star from camera based on
+        # speed, time past, and the relative velocity of each star.
+        self.s.Move(self.cam_speed * t)
+        self.ticks = time()
+
+        # Reset all stars that have "disappeared". If star-lines are
+        # being drawn, the old x/y values at these indices are
+        # reset, to keep lines from being drawn for one frame
+        # (prevents a major slowdown).
+        indices = self.s.ResetPastStars()
+        if self.show_star_lines:
+            self.old_x[indices] = self.old_y[indices] = np.inf
+
+        # Calculate rotated coord arrays based on camera orientation.
+        rx_ary, ry_ary, rz_ary = np.dot(self.Orientation(), self.s.xyz)
+
+        # Draw stars that appear ahead of the camera.
+        prep = rz_ary > 0.0
+        rx, ry, rz = rx_ary[prep], ry_ary[prep], rz_ary[prep]
+        # Get x and y screen coordinates.
+        x = self.cx + rx / rz * self.zoom
+        y = self.cy + ry / rz * self.zoom
+        # Get bright amount for visible stars.
+        # Multiply by the square-root of the relative star velocity
+        # for a nice depth-effect.
+        b = (2.0 - rz / self.w) * self.s.vel_sqrt_ary[prep]
+
+        if self.show_star_lines:
+            # Find stars that are crossing front to back.
+            diff = np.logical_and(self.s.z_ary <= 0.0, copy_z > 0.0)
+            ox, oy = self.old_x[prep], self.old_y[prep]
+            # Set old screen coords to current coords here.
+            self.old_x[prep] = x
+            self.old_y[prep] = y
+            if np.pi / 2.0 < self.yaw_ang < np.pi * 7.0 / 6.0:
+                # A fix for a weird effect that makes the lines draw
+                # incorrectly if the camera angle is pointed
+                # backward a certain amount.
+                x[diff[prep]] = -x[diff[prep]]
+                y[diff[prep]] = -y[diff[prep]]
+                ox[diff[prep]] = -ox[diff[prep]]
+                oy[diff[prep]] = -oy[diff[prep]]
+            # Make sure old x/y screen coords are within screen.
+            x_in = np.logical_and(ox > 1, ox < self.w - 1)
+            y_in = np.logical_and(oy > 1, oy < self.h - 1)
+            inside = np.logical_and(x_in, y_in)
+            # Test if x or y coords are different enough to justify
+            # drawing a line.
+            test = np.logical_or(abs(x - ox) > 2.0, abs(y - oy) > 2.0)
+            a = np.nonzero(np.logical_and(inside, test))
+            # Get the line pixels and add them to the arrays of star
+            # pixels to draw.
+            lines = self.ExtendLines(x[a], y[a], ox[a], oy[a], b[a])
+            ax = np.concatenate((x[inside], lines[0]))
+            ay = np.concatenate((y[inside], lines[1]))
+            ab = np.concatenate((b[inside], lines[2]))
+        else:
+            ax = x
+            ay = y
+            ab = b
+
+        x_in = np.logical_and(ax > 1, ax < self.w - 2)
+        y_in = np.logical_and(ay > 1, ay < self.h - 2)
+        draw = np.nonzero(np.logical_and(x_in, y_in))
+
+        return ax[draw], ay[draw], ab[draw]
+
+
+    def FrameInPlace(self, t):
+        """
+        Same as Frame(), computed in the preallocated arrays of
+        self.ws. The returned arrays are only good until the next
+        frame.
+        """
+
+        s, ws = self.s, self.ws
+        np.copyto(ws.copy_z, s.z_ary)
+        s.Move(self.cam_speed * t, ws.tmp)
+        self.ticks = time()
+
+        indices = s.ResetPastStars()
+        if self.show_star_lines:
+            self.old_x[indices] = self.old_y[indices] = np.inf
+
+        np.dot(self.Orientation(), s.xyz, out=ws.rot)
+
+        # Pack the n stars ahead of the camera to the front of the
+        # arrays, and work on views of that length from here on. A
+        # packed star-field is reordered to have them there already.
+        np.greater(ws.rz, 0.0, out=ws.prep)
+        if s.packed:
+            n = s.Partition(ws.prep, ws.rot, ws.copy_z,
+                            self.old_x, self.old_y)
+            prep = slice(0, n)
+            rx, ry, rz = ws.rx[prep], ws.ry[prep], ws.rz[prep]
+            vel_sqrt = s.vel_sqrt_ary[prep]
+        else:
+            prep = np.flatnonzero(ws.prep)
+            n = prep.size
+            rx = Take(ws.rx, prep, ws.px)
+            ry = Take(ws.ry, prep, ws.py)
+            rz = Take(ws.rz, prep, ws.pz)
+            vel_sqrt = Take(s.vel_sqrt_ary, prep, ws.tmp)
+        x = np.divide(rx, rz, out=ws.x[:n])
+        x *= self.zoom
+        x += self.cx
+        y = np.divide(ry, rz, out=ws.y[:n])
+        y *= self.zoom
+        y += self.cy
+        b = np.divide(rz, self.w, out=ws.b[:n])
+        np.subtract(2.0, b, out=b)
+        b *= vel_sqrt
+
+        if self.show_star_lines:
+            ox = Take(self.old_x, prep, ws.ox)
+            oy = Take(self.old_y, prep, ws.oy)
+            self.old_x[prep] = x
+            self.old_y[prep] = y
+            if np.pi / 2.0 < self.yaw_ang < np.pi * 7.0 / 6.0:
+                # Flip stars crossing front to back, as in Frame().
+                np.less_equal(s.z_ary, 0.0, out=ws.mask_a)
+                np.greater(ws.copy_z, 0.0, out=ws.mask_b)
+                ws.mask_a &= ws.mask_b
+                flip = Take(ws.mask_a, prep, ws.mask_b)
+                for ary in (x, y, ox, oy):
+                    np.negative(ary, out=ary, where=flip)
+            inside = InBounds(ws.mask_a[:n], ws.mask_b[:n], ox, oy,
+                              1, self.w - 1, 1, self.h - 1)
+            test = ws.mask_c[:n]
+            d = np.subtract(x, ox, out=ws.tmp[:n])
+            np.greater(np.absolute(d, out=d), 2.0, out=test)
+            np.subtract(y, oy, out=d)
+            np.greater(np.absolute(d, out=d), 2.0, out=ws.mask_b[:n])
+            test |= ws.mask_b[:n]
+            test &= inside
+            a = np.flatnonzero(test)
+            lines = ws.ExtendLines(Take(x, a, ws.lx), Take(y, a, ws.ly),
+                                   Take(ox, a, ws.lox), Take(oy, a, ws.loy),
+                                   Take(b, a, ws.lb), self.max_star_len)
+            # Star pixels inside the screen, then the line pixels.
+            inside = np.flatnonzero(inside)
+            n = inside.size + lines[0].size
+            ws.Reserve(n)
+            for src, line, dst in zip((x, y, b), lines,
+                                      (ws.ax, ws.ay, ws.ab)):
+                Take(src, inside, dst)
+                dst[inside.size:n] = line
+            ax, ay, ab = ws.ax[:n], ws.ay[:n], ws.ab[:n]
+        else:
+            ax, ay, ab = x, y, b
+
+        draw = np.flatnonzero(InBounds(ws.draw[:n], ws.draw_tmp[:n],
+                                       ax, ay, 1, self.w - 2, 1, self.h - 2))
+        return (Take(ax, draw, ws.dx), Take(ay, draw, ws.dy),
+                Take(ab, draw, ws.db))
+
+
+    def Orientation(self):
+        """
+        Return the camera orientation as a 3x3 matrix, which turns
+        star positions to face the camera: roll about the view axis,
+        then yaw.
+        """
+
+        cos_r, sin_r = np.cos(self.roll_ang), np.sin(self.roll_ang)
+        cos_y, sin_y = np.cos(self.yaw_ang), np.sin(self.yaw_ang)
+        roll = np.array([[cos_r, -sin_r, 0.0],
+                         [sin_r, cos_r, 0.0],
+                         [0.0, 0.0, 1.0]])
+        yaw = np.array([[1.0, 0.0, 0.0],
+                        [0.0, cos_y, sin_y],
+                        [0.0, -sin_y, cos_y]])
+        return np.dot(yaw, roll).astype(self.s.dtype)
 
 
     def ExtendLines(self, x, y, ox, oy, b):
         """
         Calculate and return pixels of extended lines based on given
-        arrays.
-
-        x, y: New arrays of screen x/y coordinates.
-        ox, oy: Old arrays. Lines will be attempted from x/y to ox/oy.
-        b: Brightness level of each coord.
+        arrays. See ExtendLines() at module level.
         """
 
-        # Get absolute difference between old and new arrays.
-        abs_dx = abs(ox - x).astype(int) + 1
-        abs_dy = abs(oy - y).astype(int) + 1
-        # Get maximum of previous two arrays at each element.
-        abs_max_d = np.maximum(abs_dx, abs_dy)
-        # Cap maximums to a safe value, to conserve computer time and
-        # memory, and not be overly sluggish; this limits the length of
-        # each star line, though.
-        sizes = np.minimum(self.max_star_len, abs_max_d)
-        # Initialize return arrays to correct size totals.
-        ret_x, ret_y, ret_b = (np.zeros(np.sum(sizes)) for q in range(3))
-
-        # Compute interpolated x- and y-coords and store line
-        # information in return arrays.
-        # Brightness level of each line is uniform.
-        i = 0
-        for q in range(sizes.size):
-            cap = sizes[q]
-            s = slice(i, i + cap)
-            ret_x[s] = np.linspace(x[q], ox[q], abs_max_d[q], True)[: cap]
-            ret_y[s] = np.linspace(y[q], oy[q], abs_max_d[q], True)[: cap]
-            ret_b[s] = np.zeros(cap) + b[q]
-            i += cap
-
-        return ret_x, ret_y, ret_b
+        return ExtendLines(x, y, ox, oy, b, self.max_star_len)
 
 
     def GetAverageFPS(self):
@@ -344,7 +669,10 @@ class Main:
 if __name__ == '__main__':
     if 'settings.cfg' in os.listdir('.'):
         # Config file found, read options.
-        from ConfigParser import RawConfigParser
+        try:
+            from ConfigParser import RawConfigParser
+        except ImportError:
+            from configparser import RawConfigParser
 
         cfg_parser = RawConfigParser()
         cfg_parser.read('settings.cfg')
@@ -373,6 +701,16 @@ if __name__ == '__main__':
         stars = cfg_parser.getint('Display', 'stars')
 
         e = cfg_parser.getboolean('Display', 'lines')
+
+        if cfg_parser.has_option('Display', 'workspace'):
+            ws = cfg_parser.getboolean('Display', 'workspace')
+        else:
+            ws = True
+
+        if cfg_parser.has_option('Display', 'packed'):
+            p = cfg_parser.getboolean('Display', 'packed')
+        else:
+            p = False
     else:
         # Set options to reasonable values.
         w, h = 640, 480
@@ -380,12 +718,14 @@ if __name__ == '__main__':
         m = DrawPixelQuads
         stars = 2048
         e = False
+        ws = True
+        p = False
 
     # Instantiate main program with options.
-    program = Main(w, h, f, 8, m, stars, e)
+    program = Main(w, h, f, 8, m, stars, e, ws, p)
 
     # Begin the main loop.
     fps = program.Begin()
 
     # Print out an average frames-per-second for the run.
-    print "Average FPS: %.2f" % fps
+    print("Average FPS: %.2f" % fps)
@@ -219,7 +219,7 @@ class Main:
                     DrawWuLine(self.scl_sfc, x1, y1, x2, y2, level)
                     c += 1
             if self.show_counts:
-                print c
+                print(c)
             temp_sfc = pg.transform.scale(self.scl_sfc, (self.fw, self.fh))
             self.screen.blit(temp_sfc, (0, 0))
             pg.display.update()
@@ -1,15 +1,17 @@
+import threading, time, atexit, sys, os, io, math, random, struct, collections, mmap, types, weakref, traceback
+
 try:
-    from smbus import SMBus
+  import numpy
 except ImportError:
-    exit("This library requires python-smbus\nInstall with: sudo apt-get install python-smbus")
-
-import threading, time, atexit, sys
-import RPi.GPIO as GPIO
+  numpy = None
 
 SW_ADDR = 0x42
 SW_RESET_PIN = 17
 SW_XFER_PIN  = 27
 
+SW_XFER_TIMEOUT  = 100   # ms to block waiting for a TS edge before re-checking
+SW_POLL_INTERVAL = 0.001 # seconds between checks when edge detection is unavailable
+
 SW_HEADER_SIZE   = 4
 
 SW_DATA_DSP      = 0b0000000000000001
@@ -17,6 +19,7 @@ SW_DATA_GESTURE  = 0b0000000000000010
 SW_DATA_TOUCH    = 0b0000000000000100
 SW_DATA_AIRWHEEL = 0b0000000000001000
 SW_DATA_XYZ      = 0b0000000000010000
+SW_DATA_NOISE    = 0b0000000000100000
 
 SW_SYSTEM_STATUS = 0x15
 SW_REQUEST_MSG   = 0x06
@@ -24,37 +27,275 @@ SW_FW_VERSION    = 0x83
 SW_SET_RUNTIME   = 0xA2
 SW_SENSOR_DATA   = 0x91
 
+'''
+Runtime parameters for SW_SET_RUNTIME, see set_runtime_parameter()
+
+DATA_OUTPUT_ENABLE: Argument0 is the DataOutputConfigMask,
+  Argument1 selects which of its bits to change
+DATA_OUTPUT_LOCK: same, but locked outputs are sent even when
+  not valid, so the message layout stays fixed
+DATA_OUTPUT_REQUEST: same, outputs are sent once on request
+APPROACH_DETECTION: Argument0 bit 0 enables, Argument1 = 0x01
+TOUCH_DETECTION: Argument0 bit 3 enables, Argument1 = 0x08
+AIRWHEEL: Argument0 bit 5 enables, Argument1 = 0x20
+GESTURE_PROCESSING: Argument0 is a mask of gestures to
+  recognise, Argument1 = 0x7F
+TRIGGER: Argument0 = 0x00 forces a calibration
+MAKE_PERSISTENT: store parameters in flash
+'''
+SW_PARAM_APPROACH_DETECTION  = 0x0097
+SW_PARAM_TOUCH_DETECTION     = 0x0097
+SW_PARAM_AIRWHEEL            = 0x0090
+SW_PARAM_GESTURE_PROCESSING  = 0x0085
+SW_PARAM_DATA_OUTPUT_ENABLE  = 0x00A0
+SW_PARAM_DATA_OUTPUT_LOCK    = 0x00A1
+SW_PARAM_DATA_OUTPUT_REQUEST = 0x00A2
+SW_PARAM_TRIGGER             = 0x1000
+SW_PARAM_MAKE_PERSISTENT     = 0xFF00
+
+SW_MAX_MSG_SIZE  = 32 # Largest transfer an SMBus block read can return
+SW_I2C_HZ        = 100000 # Bus clock, used to estimate how long TS is held low
+SW_REPLY_TIMEOUT = 0.1 # seconds to keep reads wide while waiting for a reply
+SW_OUTPUT_MASK   = SW_DATA_DSP | SW_DATA_GESTURE | SW_DATA_TOUCH | SW_DATA_AIRWHEEL | SW_DATA_XYZ
+SW_OUTPUT_BITS   = 0b0000000000111111 # DataOutputConfigMask bits the driver manages
+SW_RING_SIZE     = 1024 # Samples of history kept for drain(), ~5 seconds at 200Hz
+SW_DISPATCH_QUEUE = 256 # Events waiting for handlers before the oldest are dropped
+SW_PREDICT_SAMPLES = 16    # Positions kept for predict()
+SW_PREDICT_WINDOW  = 0.05  # seconds of history predict() fits a velocity to
+SW_PREDICT_HORIZON = 0.1   # seconds predict() will extrapolate at most
+SW_AIRWHEEL_STEPS  = 32    # AirWheelInfo counts per full turn
+SW_AIRWHEEL_TAU    = 0.1   # seconds the airwheel velocity is smoothed over
+SW_HEALTH_TIMEOUT  = 1.0   # seconds get_firmware()/get_status() wait for an answer
+SW_WATCHDOG_INTERVAL  = 0.1 # seconds between watchdog checks
+SW_WATCHDOG_SILENCE   = 0.5 # seconds without a message before the chip counts as hung
+SW_WATCHDOG_DSP       = 1.0 # seconds DSPRunning may stay clear
+SW_RECOVERY_DELAY     = 0.1 # seconds before the first recovery attempt, doubled for each retry
+SW_RECOVERY_MAX_DELAY = 5.0 # longest wait between recovery attempts
+SW_RECOVERY_ATTEMPTS  = 8   # recovery attempts before giving up
+SW_LATENCY_SAMPLE     = 16  # events delivered per latency measurement
+
+SW_SYSINFO_NOISE    = 0b00010000 # EnvironmentalNoise
+SW_SYSINFO_CLIPPING = 0b00100000 # Clipping
+SW_SYSINFO_DSP      = 0b10000000 # DSPRunning
+_SYSINFO_HEALTH     = SW_SYSINFO_NOISE | SW_SYSINFO_CLIPPING | SW_SYSINFO_DSP
+
+'''
+Precompiled message layouts, all little-endian
+
+_PAYLOAD_HEADER: DataOutputConfigMask, TimeStamp, SystemInfo
+_FIRMWARE_PAYLOAD: FwValid, HwRev, ParamStartAddr,
+  LibLoaderVersion (3 bytes), FwStartAddr, then the version string
+_SYSTEM_STATUS: ID of the message answered, MaxCmdSize, ErrorCode
+_REQUEST_MSG: size, flags, seq, ID, ID of the message requested, Param
+'''
+_PAYLOAD_HEADER   = struct.Struct('<HBB')
+_FIRMWARE_PAYLOAD = struct.Struct('<BHBBBBB')
+_SET_RUNTIME      = struct.Struct('<4BH2xII')
+_SYSTEM_STATUS    = struct.Struct('<BBH')
+_REQUEST_MSG      = struct.Struct('<4BB3xI')
+
+'''
+Optional sensor data fields, in the order they follow the
+payload header, with their sizes. A field is only present
+when its bit is set in the message's DataOutputConfigMask.
+'''
+_SENSOR_FIELDS = (
+  (SW_DATA_DSP,      2),
+  (SW_DATA_GESTURE,  4),
+  (SW_DATA_TOUCH,    4),
+  (SW_DATA_AIRWHEEL, 2),
+  (SW_DATA_XYZ,      6),
+  (SW_DATA_NOISE,    4)
+)
+
+'''
+struct formats of the _SENSOR_FIELDS as sensor_decoder() unpacks
+them, fields the decoder does not use are skipped as padding
+
+gesture: gesture, class (high nibble), edge flick (bit 0),
+  then a byte holding gesture in progress (bit 7)
+touch: action bits, touch counter, reserved
+airwheel: counter, reserved
+xyz: x, y, z
+'''
+_SENSOR_FORMATS = {
+  SW_DATA_DSP:      '2x',
+  SW_DATA_GESTURE:  'BBBx',
+  SW_DATA_TOUCH:    'HBx',
+  SW_DATA_AIRWHEEL: 'Bx',
+  SW_DATA_XYZ:      '3H',
+  SW_DATA_NOISE:    '4x'
+}
+
+_layouts = {}
+_decoders = {}
+
+def sensor_layout(mask):
+  '''
+  Return (offsets, size) for a sensor data message
+
+  offsets holds, for each of _SENSOR_FIELDS, where that field
+  starts relative to the payload, or -1 when mask leaves it out.
+  size is the whole message including its header. Layouts are
+  cached, so this is a dict lookup after the first call.
+  '''
+  layout = _layouts.get(mask)
+  if layout == None:
+    offsets = []
+    pos = _PAYLOAD_HEADER.size
+    for bit, size in _SENSOR_FIELDS:
+      if mask & bit:
+        offsets.append(pos)
+        pos += size
+      else:
+        offsets.append(-1)
+    layout = (tuple(offsets), SW_HEADER_SIZE + pos)
+    _layouts[mask] = layout
+  return layout
+
+def sensor_decoder(mask):
+  '''
+  Return (mask, unpacker, gesture, touch, airwheel, xyz) for a
+  sensor data message
+
+  unpacker is a struct that reads a whole message, the header,
+  the payload header and every field mask says is present, in
+  one call. The others are where that field's first value sits
+  in what it returns, or -1 when mask leaves it out. Decoders are
+  cached like layouts.
+  '''
+  decoder = _decoders.get(mask)
+  if decoder == None:
+    fmt = '<4BHBB'
+    index = {}
+    count = 7
+    for bit, size in _SENSOR_FIELDS:
+      if mask & bit:
+        field = struct.Struct('<' + _SENSOR_FORMATS[bit])
+        index[bit] = count
+        count += len(field.unpack(bytes(bytearray(size))))
+        fmt += _SENSOR_FORMATS[bit]
+    decoder = (mask, struct.Struct(fmt),
+               index.get(SW_DATA_GESTURE, -1), index.get(SW_DATA_TOUCH, -1),
+               index.get(SW_DATA_AIRWHEEL, -1), index.get(SW_DATA_XYZ, -1))
+    _decoders[mask] = decoder
+  return decoder
+
+GESTURES = (
+  ('garbage','',''),
+  ('flick','west','east'),
+  ('flick','east','west'),
+  ('flick','south','north'),
+  ('flick','north','south'),
+  ('circle','clockwise',''),
+  ('circle','counter-clockwise','')
+)
+
+'''
+Event kind and leading args for each gesture code, from GESTURES
+with the blank directions left out. Events carry these followed
+by the edge flag and the host timestamp, handlers only get the
+directions unless they subscribe with details set.
+'''
+_GESTURE_EVENTS = tuple((gesture[0], tuple(d for d in gesture[1:] if d)) for gesture in GESTURES)
+_GESTURE_ARITY = dict((kind, len(args)) for kind, args in _GESTURE_EVENTS)
+
+TOUCH_ACTIONS = (
+  ('touch','south'),
+  ('touch','west'),
+  ('touch','north'),
+  ('touch','east'),
+  ('touch','center'),
+  ('tap','south'),
+  ('tap','west'),
+  ('tap','north'),
+  ('tap','east'),
+  ('tap','center'),
+  ('doubletap','south'),
+  ('doubletap','west'),
+  ('doubletap','north'),
+  ('doubletap','east'),
+  ('doubletap','center')
+)
+
+_TOUCH_MASK = (1 << len(TOUCH_ACTIONS)) - 1
+_TOUCH_KINDS = frozenset(action[0] for action in TOUCH_ACTIONS)
+_TOUCH_POSITIONS = tuple(sorted(set(action[1] for action in TOUCH_ACTIONS)))
+
+'''
+The DataOutputConfigMask bits each kind of event is decoded from
+'''
+_EVENT_OUTPUTS = {
+  'move':      SW_DATA_XYZ,
+  'flick':     SW_DATA_GESTURE,
+  'circle':    SW_DATA_GESTURE,
+  'garbage':   SW_DATA_GESTURE,
+  'touch':     SW_DATA_TOUCH,
+  'tap':       SW_DATA_TOUCH,
+  'doubletap': SW_DATA_TOUCH,
+  'airwheel':  SW_DATA_AIRWHEEL
+}
+
+'''
+Backend selection, 'hardware' talks to the real hat through
+python-smbus and RPi.GPIO, 'sim' runs an in-process simulated
+MGC3130 so the driver works on any Linux box and 'replay' plays
+back the capture file named by SKYWRITER_REPLAY
+'''
+SW_BACKEND  = os.environ.get('SKYWRITER_BACKEND', 'hardware')
+SW_SIM_RATE = float(os.environ.get('SKYWRITER_SIM_RATE', 200))
+SW_REPLAY   = os.environ.get('SKYWRITER_REPLAY')
+
+'''
+Capture file layout, all little-endian
+
+A 16 byte header: magic, format version, record size
+Then fixed size records, one per message read: host timestamp
+(double), message length, padding, then the raw message bytes
+padded to SW_MAX_MSG_SIZE
+
+Fixed size records mean record i is at a known offset, so long
+captures can be memory mapped and read from anywhere.
+'''
+SW_CAPTURE_MAGIC   = b'SKYW'
+SW_CAPTURE_VERSION = 1
+_CAPTURE_HEADER = struct.Struct('<4sHH8x')
+_CAPTURE_RECORD = struct.Struct('<dB7x%ds' % SW_MAX_MSG_SIZE)
+
 def i2c_bus_id():
-  revision = ([l[12:-1] for l in open('/proc/cpuinfo','r').readlines() if l[:8]=="Revision"]+['0000'])[0]
+  revision = ([l[12:-1] for l in io.open('/proc/cpuinfo','r').readlines() if l[:8]=="Revision"]+['0000'])[0]
   return 1 if int(revision, 16) >= 4 else 0
 
-i2c = SMBus(i2c_bus_id())
+def hardware_backend(bus_id=None):
+  '''
+  Open a real I2C bus and the GPIO lines
+
+  bus_id defaults to the bus the hat sits on, i2c_bus_id().
+  Returns an (i2c, GPIO) pair for use_backend()
+  '''
+  try:
+    from smbus import SMBus
+  except ImportError:
+    exit("This library requires python-smbus\nInstall with: sudo apt-get install python-smbus")
+
+  import RPi.GPIO
 
-GPIO.setmode(GPIO.BCM)
-GPIO.setup(SW_RESET_PIN, GPIO.OUT, initial=GPIO.HIGH)
-GPIO.setup(SW_XFER_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+  return SMBus(i2c_bus_id() if bus_id == None else bus_id), RPi.GPIO
 
 x = 0.0
 y = 0.0
 z = 0.0
-rotation = 0.0
-lastrotation = 0.0
 gesture = 0
 
-worker = None
-_on_flick    = None
-_on_move     = None
-_on_airwheel = []
-_on_touch    = {}
-_on_garbage  = None
-_on_circle   = {}
-
-def reset():
-  GPIO.output(SW_RESET_PIN, GPIO.LOW)
-  time.sleep(.1)
-  GPIO.output(SW_RESET_PIN, GPIO.HIGH)
-  time.sleep(.5) # Datasheet delay of 200ms plus change
-  #time.sleep(3)
+'''
+Settings copied by each new Skywriter, set them before first use
+to change the default device
+'''
+use_interrupts = True
+autostart = True # Open and start polling when the first handler is registered
+threaded_dispatch = True # Run handlers on a separate thread from the poller
+auto_mask = True # Only enable the outputs registered handlers and consumers need
+auto_recover = True # Reset and reconfigure a device that hangs or errors, see Watchdog
 
 class StoppableThread(threading.Thread):
   '''
@@ -69,12 +310,12 @@ class StoppableThread(threading.Thread):
     self.daemon = True         
 
   def start(self):
-    if self.isAlive() == False:
+    if self.is_alive() == False:
       self.stop_event.clear()
       threading.Thread.start(self)
 
   def stop(self):
-    if self.isAlive() == True:
+    if self.is_alive() == True:
       # set event to signal thread to terminate
       self.stop_event.set()
       # block calling thread until thread really has terminated
@@ -99,181 +340,1873 @@ class AsyncWorker(StoppableThread):
         self.stop_event.set()
         break
 
-def handle_sensor_data(data):
-  global lastrotation, rotation
-  '''
-  | HEADER | PAYLOAD
-  |        |  DataOutputConfigMask 2 | TimeStamp 1 | SystemInfo 1 | Content |
-  
-  DataOutputConfigMask
-  Bit 0 - DSPStatus
-  Bit 1 - GestureInfo
-  Bit 2 - TouchInfo
-  Bit 3 - AirWheelInfo
-  Bit 4 - XYZ Position
-  Bit 5 - NoisePower
-  Bit 6-7 - Reserved
-  Bit 8-10 - ElectrodeConfiguration
-  Bit 11 - CICData
-  Bit 12 - SDData
-  Bit 13-15 - Reserved
-  
-  SystemInfo
-  Bit 0 - PositionValid, indicates xyz pos data is valid
-  Bit 1 - AirWheelValid, indicates AirWheel is active and AirWheelInfo is vaid
-  Bit 2 - RawDataValid, indicates CICData and SDData fields are valid
-  Bit 3 - NoisePowerValid, indicates NoisePower field is valid
-  Bit 4 - EnvironmentalNoise, indicates that environmental noise has been detected
-  Bit 5 - Clipping, indicates that the ADCs are clipping
-  Bit 6 - Reserved
-  Bit 7 - DSPRunning, indicates the system is currently running
-
-  DSPStatus - 2 bytes -
-  GestureInfo - 4 bytes
-  TouchInfo - 4 bytes
-  AirWheelInfo - 2 bytes - first byte indicates rotation, ++ = clockwise, 32 = 1 rotation
-  xyzPosition - 6 bytes - 1+2 = x, 3-4 = y, 5-6 = z
-  NoisePower
-  CICData
-  SDData
-  '''
-  
-  d_configmask = data.pop(0) | data.pop(0) << 8
-  d_timestamp  = data.pop(0) # 200hz, 8-bit counter, max ~1.25sec
-  d_sysinfo    = data.pop(0)
-  
-  d_dspstatus = data[0:2]
-  d_gesture   = data[2:6]
-  d_touch     = data[6:10]
-  d_airwheel  = data[10:12]
-  d_xyz       = data[12:20]
-  d_noisepow  = data[20:24]
- 
-  if d_configmask & SW_DATA_XYZ and d_sysinfo & 0b0000001:
-    # We have xyz info, and it's valid
-    x, y, z = (
-      (d_xyz[1] << 8 | d_xyz[0]) / 65536.0,
-      (d_xyz[3] << 8 | d_xyz[2]) / 65536.0,
-      (d_xyz[5] << 8 | d_xyz[4]) / 65536.0
-    ) 
-    if callable(_on_move):
-      _on_move(x, y, z)
-    #print( x, y, z )
-  
-  if d_configmask & SW_DATA_GESTURE and not d_gesture[0] == 0:
-    # We have a gesture!
-    is_edge = (d_gesture[3] & 0b00000001) > 0
-    gestures = [
-      ('garbage','',''),
-      ('flick','west','east'),
-      ('flick','east','west'),
-      ('flick','south','north'),
-      ('flick','north','south'),
-      ('circle','clockwise',''),
-      ('circle','counter-clockwise','')
-    ]
-    for i,gesture in enumerate(gestures):
-      if d_gesture[0] == i + 1:
-
-        if gesture[0] == 'flick' and callable(_on_flick):
-          _on_flick(gesture[1], gesture[2])
+class Snapshot(object):
+  '''
+  Latest position sample, published without a lock
 
-        break
+  The poller is the only writer. Each update builds a complete
+  (x, y, z, timestamp, seq) tuple and rebinds a single attribute,
+  which is atomic, so a reader always gets all five values from
+  the same frame. timestamp is the host time the frame was read,
+  seq counts published samples and starts at 0 for "none yet".
+  '''
+  __slots__ = ('sample',)
 
-  if d_configmask & SW_DATA_TOUCH:
-    # We have a touch
-    d_action = d_touch[1] << 8 | d_touch[0]
-
-    d_touchcount = d_touch[2] * 5 # Time to touch in ms
-    actions = [
-      ('touch','south'),
-      ('touch','west'),
-      ('touch','north'),
-      ('touch','east'),
-      ('touch','center'),
-      ('tap','south'),
-      ('tap','west'),
-      ('tap','north'),
-      ('tap','east'),
-      ('tap','center'),
-      ('doubletap','south'),
-      ('doubletap','west'),
-      ('doubletap','north'),
-      ('doubletap','east'),
-      ('doubletap','center')
-    ]
-
-    comp = 0b0000000000000001 << len(actions)-1
-    for action in reversed(actions):
-      if d_action & comp:
-        #print(action, d_touchcount)
-
-        if action[0] in _on_touch.keys() and action[1] in _on_touch[action[0]].keys():
-          if callable(_on_touch[action[0]][action[1]]):
-            _on_touch[action[0]][action[1]]()
-
-        if action[0] in _on_touch.keys() and 'all' in _on_touch[action[0]].keys():
-          if callable(_on_touch[action[0]]['all']):
-            _on_touch[action[0]]['all'](action[1])
+  def __init__(self):
+    self.sample = (0.0, 0.0, 0.0, 0.0, 0)
 
-        break
-      comp = comp >> 1
-
-  if d_configmask & SW_DATA_AIRWHEEL and d_sysinfo & 0b00000010:
-    # Airwheel
-    delta = (d_airwheel[0] - lastrotation) / 32.0
-    '''
-    Delta is in degrees, with 1 = full 360 degree rotation
-    Positive numbers equal clockwise delta, negative are counter-clockwise
-    '''
-    if delta != 0 and delta > -0.5 and delta < 0.5:
-      #rotation += (delta * 360.0)
-      #rotation %= 360.0
-      if callable(_on_airwheel):
-        _on_airwheel(delta * 360.0)
-
-      rotation += delta
-      if rotation < 0:
-        rotation = 0
-      if rotation > 1000:
-        rotation = 1000
-      #print('Airwheel:',delta, rotation)
-    lastrotation = d_airwheel[0]
 '''
-    if lastrotation > d_airwheel[0]:
-      rotation -= (lastrotation - d_airwheel[0]) / 32.0
-    if lastrotation < d_airwheel[0]:
-      rotation += (d_airwheel[0] - lastrotation) / 32.0
-    print('Airwheel:', rotation, (rotation * 360) % 360)
-    lastrotation = d_airwheel[0]
+One decoded sensor frame as stored by SampleRing
+
+seq: count of frames stored, starting at 1
+timestamp: host time the frame was read
+counter: the MGC3130's own 200Hz TimeStamp byte
+sysinfo: SystemInfo flags, bit 0 says whether x/y/z are valid
+x, y, z: position, 0.0 to 1.0
+airwheel: raw AirWheelInfo counter
 '''
-def handle_status_info(data):
-  error = data[7] << 8 | data[6]
+if numpy != None:
+  SAMPLE_DTYPE = numpy.dtype([
+    ('seq',       numpy.uint32),
+    ('timestamp', numpy.float64),
+    ('counter',   numpy.uint8),
+    ('sysinfo',   numpy.uint8),
+    ('x',         numpy.float32),
+    ('y',         numpy.float32),
+    ('z',         numpy.float32),
+    ('airwheel',  numpy.uint8)
+  ])
+
+class SampleRing(object):
+  '''
+  Fixed-capacity history of decoded sensor frames
+
+  Backed by a preallocated NumPy structured array twice the
+  capacity. Every sample is written into both halves so any run
+  of up to capacity consecutive samples is contiguous, and can be
+  handed out as a view without copying.
+
+  The poller is the only writer, it fills the slot before bumping
+  count, so readers never see a half-written sample.
+  '''
+  def __init__(self, capacity=SW_RING_SIZE):
+    if numpy == None:
+      raise ImportError("SampleRing requires numpy\nInstall with: sudo apt-get install python-numpy")
+    self.capacity = capacity
+    self.data = numpy.zeros(capacity * 2, dtype=SAMPLE_DTYPE)
+    self.count = 0
+
+  def push(self, timestamp, counter, sysinfo, x, y, z, airwheel):
+    i = self.count % self.capacity
+    sample = (self.count + 1, timestamp, counter, sysinfo, x, y, z, airwheel)
+    self.data[i] = sample
+    self.data[i + self.capacity] = sample
+    self.count += 1
+
+  def view(self, start, end):
+    '''
+    Return samples start to end (counted from 0) as an array view
 
-def handle_firmware_info(data):
-  print('Got firmware info')
+    The range must lie within the last capacity samples.
+    '''
+    i = start % self.capacity
+    return self.data[i:i + end - start]
+
+  def reader(self):
+    '''
+    Return a new RingReader that starts at the newest sample
+    '''
+    return RingReader(self)
 
-  d_fw_valid = data.pop(0)
-  d_hw_rev = data.pop(0) | data.pop(0) << 8
-  d_param_st = data.pop(0)
-  d_loader_version = [ data.pop(0), data.pop(0), data.pop(0) ],
-  d_fw_st = data.pop(0)
-  d_fw_version = ''.join(map(chr,data))
+class RingReader(object):
+  '''
+  One consumer's position in a SampleRing
 
-  print(d_fw_version)
+  drain() returns every sample stored since the previous call
+  as a single structured array view. If the reader falls more
+  than capacity samples behind, the oldest are skipped and
+  counted in dropped.
 
-def _do_poll():
+  The view shares memory with the ring, copy it if it needs to
+  outlive the next capacity samples.
+  '''
+  def __init__(self, ring):
+    self.ring = ring
+    self.cursor = ring.count
+    self.dropped = 0
+
+  def drain(self):
+    count = self.ring.count
+    start = self.cursor
+    if count - start > self.ring.capacity:
+      self.dropped += count - start - self.ring.capacity
+      start = count - self.ring.capacity
+    self.cursor = count
+    return self.ring.view(start, count)
+
+class Stats(object):
+  '''
+  Frame loss and latency counters for the polling loop
+
+  frames_received: messages of any kind read from the MGC3130
+  frames_dropped: messages the chip sent that were never read,
+    from gaps in the 8-bit header sequence number
+  sensor_frames: sensor data (0x91) messages among those received
+  truncated: messages longer than the read that fetched them,
+    these are discarded
+  bytes_read: bytes transferred from the MGC3130
+  bus_time: estimated seconds spent on those transfers, the time
+    TS was held low
+  device_ticks: the chip's 200Hz TimeStamp counter, unwrapped
+  counter_wraps: times that 8-bit counter has wrapped
+  latency_hist: time from I2C read to handlers returning, one
+    entry per SW_LATENCY_SAMPLE events delivered to a handler,
+    bucket i counts latencies of under 2**i microseconds (and at
+    least 2**(i-1)), the last bucket catches everything slower
+
+  The polling thread updates the frame and transfer counters.
+  The latency fields are updated by whichever thread calls the
+  handlers, the dispatcher thread with threaded_dispatch set,
+  otherwise the polling thread, so each field still has a single
+  writer and readers just see plain numbers. The decoder bumps
+  the counters itself and only calls in here for the rare cases,
+  a sequence gap, a stalled counter or a latency sample, so
+  bookkeeping stays off the hot path.
+  '''
+  LATENCY_BUCKETS = 24
 
-  if not GPIO.input(SW_XFER_PIN):
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.frames_received = 0
+    self.frames_dropped = 0
+    self.sensor_frames = 0
+    self.truncated = 0
+    self.bytes_read = 0
+    self.bus_time = 0.0
+    self.device_ticks = 0
+    self.latency_hist = [0] * self.LATENCY_BUCKETS
+    self.latency_count = 0
+    self.latency_total = 0.0
+    self.latency_max = 0.0
+    self.latency_skip = SW_LATENCY_SAMPLE
+    self.next_seq = None
+    self.last_counter = None
+    self.last_time = float('-inf')
+    self._first_counter = 0
+
+  def transfer(self, size, seconds):
+    self.bytes_read += size
+    self.bus_time += seconds
+
+  def message(self, seq):
     '''
-    Assert transfer line low to ensure
-    MGC3130 doesn't update data buffers
+    Count one message, the decoder does this inline while seq
+    is the expected next_seq
+    '''
+    if self.next_seq != None:
+      self.frames_dropped += (seq - self.next_seq) & 0xff
+    self.next_seq = (seq + 1) & 0xff
+    self.frames_received += 1
+
+  def sensor(self, counter, timestamp):
+    '''
+    Count one sensor frame, the decoder does this inline unless
+    frames stopped for over a second
+    '''
+    self.sensor_frames += 1
+    if self.last_counter == None:
+      self._first_counter = counter
+    else:
+      ticks = (counter - self.last_counter) & 0xff
+      if timestamp - self.last_time > 1.0:
+        '''
+        The counter wraps every 1.28 seconds, if frames stopped for
+        that long, host time says how many wraps were missed
+        '''
+        expected = (timestamp - self.last_time) * 200.0
+        missed = int(round((expected - ticks) / 256.0))
+        if missed > 0:
+          ticks += missed * 256
+      self.device_ticks += ticks
+    self.last_counter = counter
+    self.last_time = timestamp
+
+  def latency(self, seconds):
+    self.latency_skip = SW_LATENCY_SAMPLE
+    bucket = int(seconds * 1000000).bit_length()
+    if bucket >= self.LATENCY_BUCKETS:
+      bucket = self.LATENCY_BUCKETS - 1
+    self.latency_hist[bucket] += 1
+    self.latency_count += 1
+    self.latency_total += seconds
+    if seconds > self.latency_max:
+      self.latency_max = seconds
+
+  def get(self):
+    return {
+      'frames_received': self.frames_received,
+      'frames_dropped':  self.frames_dropped,
+      'sensor_frames':   self.sensor_frames,
+      'truncated':       self.truncated,
+      'bytes_read':      self.bytes_read,
+      'bus_time':        self.bus_time,
+      'device_ticks':    self.device_ticks,
+      'counter_wraps':   (self._first_counter + self.device_ticks) >> 8,
+      'latency_hist':    list(self.latency_hist),
+      'latency_mean':    self.latency_total / max(1, self.latency_count),
+      'latency_max':     self.latency_max
+    }
+
+class Filter(object):
+  '''
+  Base class for motion filters, see set_filter()
+
+  update() filters one position in constant time, keeping only
+  a few floats of state between samples. apply() runs the same
+  filter over a batch of SAMPLE_DTYPE samples, such as drain()
+  returns, and carries state on from one batch to the next.
+  '''
+  def reset(self):
+    pass
+
+  def update(self, x, y, z, t):
+    return x, y, z
+
+  def apply(self, samples):
+    '''
+    Filter the valid positions in samples
+
+    Returns a new SAMPLE_DTYPE array holding only the samples with
+    a valid position, with x, y and z filtered. The input is left
+    untouched as it is usually a view into the ring.
+    '''
+    samples = samples[(samples['sysinfo'] & 0b00000001) != 0]
+    update = self.update
+    xs, ys, zs = samples['x'], samples['y'], samples['z']
+    for i, t in enumerate(samples['timestamp'].tolist()):
+      xs[i], ys[i], zs[i] = update(float(xs[i]), float(ys[i]), float(zs[i]), t)
+    return samples
+
+class EMAFilter(Filter):
+  '''
+  Exponential moving average
+
+  alpha is the weight given to each new sample, from 0.0 (never
+  move) to 1.0 (no smoothing). Batches are filtered without a
+  Python loop.
+  '''
+  def __init__(self, alpha=0.5):
+    self.alpha = alpha
+    self.reset()
+
+  def reset(self):
+    self.primed = False
+    self.x = self.y = self.z = 0.0
+
+  def update(self, x, y, z, t):
+    if self.primed:
+      a = self.alpha
+      self.x += a * (x - self.x)
+      self.y += a * (y - self.y)
+      self.z += a * (z - self.z)
+    else:
+      self.x, self.y, self.z = x, y, z
+      self.primed = True
+    return self.x, self.y, self.z
+
+  def apply(self, samples):
+    samples = samples[(samples['sysinfo'] & 0b00000001) != 0]
+    if samples.size == 0:
+      return samples
+    if not self.primed:
+      self.x, self.y, self.z = float(samples['x'][0]), float(samples['y'][0]), float(samples['z'][0])
+      self.primed = True
+    self.x = self._smooth(samples['x'], self.x)
+    self.y = self._smooth(samples['y'], self.y)
+    self.z = self._smooth(samples['z'], self.z)
+    return samples
+
+  def _smooth(self, values, state):
+    '''
+    Filter values in place, starting from state
+
+    Unrolls s[n] = b*s[n-1] + a*x[n] to s[n] = b**n * (state +
+    a * sum(x[k] / b**k)), over blocks short enough that b**-k
+    stays well inside float range.
+    '''
+    a = self.alpha
+    b = 1.0 - a
+    if b <= 0.0:
+      return float(values[-1])
+    block = max(1, int(150 / -math.log10(b))) if b < 1.0 else len(values)
+    for start in range(0, len(values), block):
+      chunk = values[start:start + block]
+      powers = b ** numpy.arange(1, len(chunk) + 1, dtype=numpy.float64)
+      chunk[:] = powers * (state + a * numpy.cumsum(chunk / powers))
+      state = float(chunk[-1])
+    return state
+
+class OneEuroFilter(Filter):
+  '''
+  One Euro filter, Casiez et al. 2012
+
+  An EMA whose cutoff rises with speed, smoothing jitter while
+  the hand is still without lagging behind fast moves.
+  min_cutoff (Hz) sets smoothing at rest, beta how quickly the
+  cutoff rises with speed, d_cutoff (Hz) smooths the speed
+  estimate itself.
+  '''
+  def __init__(self, min_cutoff=1.0, beta=20.0, d_cutoff=1.0):
+    self.min_cutoff = min_cutoff
+    self.beta = beta
+    self.d_cutoff = d_cutoff
+    self.reset()
+
+  def reset(self):
+    self.t = None
+    self.x = self.y = self.z = 0.0
+    self.dx = self.dy = self.dz = 0.0
+
+  def _alpha(self, cutoff, dt):
+    tau = 1.0 / (2.0 * math.pi * cutoff)
+    return 1.0 / (1.0 + tau / dt)
+
+  def update(self, x, y, z, t):
+    if self.t == None:
+      self.t = t
+      self.x, self.y, self.z = x, y, z
+      return x, y, z
+
+    dt = t - self.t
+    if dt <= 0.0:
+      dt = 1.0 / 200
+    self.t = t
+
+    ad = self._alpha(self.d_cutoff, dt)
+    self.dx += ad * ((x - self.x) / dt - self.dx)
+    self.dy += ad * ((y - self.y) / dt - self.dy)
+    self.dz += ad * ((z - self.z) / dt - self.dz)
+
+    self.x += self._alpha(self.min_cutoff + self.beta * abs(self.dx), dt) * (x - self.x)
+    self.y += self._alpha(self.min_cutoff + self.beta * abs(self.dy), dt) * (y - self.y)
+    self.z += self._alpha(self.min_cutoff + self.beta * abs(self.dz), dt) * (z - self.z)
+    return self.x, self.y, self.z
+
+class _KalmanAxis(object):
+  '''
+  Constant velocity Kalman filter for one axis
+
+  State is position p and velocity v, with covariance
+  [[p00, p01], [p01, p11]].
+  '''
+  __slots__ = ('p', 'v', 'p00', 'p01', 'p11')
+
+  def __init__(self, p):
+    self.p, self.v = p, 0.0
+    self.p00, self.p01, self.p11 = 1.0, 0.0, 1.0
+
+  def update(self, z, dt, q, r):
+    # Predict
+    self.p += self.v * dt
+    dt2 = dt * dt
+    self.p00 += dt * (2.0 * self.p01 + dt * self.p11) + q * dt2 * dt2 / 4.0
+    self.p01 += dt * self.p11 + q * dt2 * dt / 2.0
+    self.p11 += q * dt2
+
+    # Correct
+    s = self.p00 + r
+    k0 = self.p00 / s
+    k1 = self.p01 / s
+    error = z - self.p
+    self.p += k0 * error
+    self.v += k1 * error
+    self.p11 -= k1 * self.p01
+    self.p00 -= k0 * self.p00
+    self.p01 -= k0 * self.p01
+    return self.p
+
+class KalmanFilter(Filter):
+  '''
+  Constant velocity Kalman filter on each axis
+
+  process_noise is the expected acceleration variance, higher
+  follows the hand more tightly. measurement_noise is the sensor's
+  position variance, higher smooths harder. Velocity estimates
+  are kept in vx, vy and vz.
+  '''
+  def __init__(self, process_noise=50.0, measurement_noise=0.0005):
+    self.process_noise = process_noise
+    self.measurement_noise = measurement_noise
+    self.reset()
+
+  def reset(self):
+    self.t = None
+    self.axes = None
+
+  @property
+  def vx(self):
+    return self.axes[0].v if self.axes else 0.0
+
+  @property
+  def vy(self):
+    return self.axes[1].v if self.axes else 0.0
+
+  @property
+  def vz(self):
+    return self.axes[2].v if self.axes else 0.0
+
+  def update(self, x, y, z, t):
+    if self.t == None:
+      self.t = t
+      self.axes = (_KalmanAxis(x), _KalmanAxis(y), _KalmanAxis(z))
+      return x, y, z
+
+    dt = t - self.t
+    if dt <= 0.0:
+      dt = 1.0 / 200
+    self.t = t
+
+    q, r = self.process_noise, self.measurement_noise
+    ax, ay, az = self.axes
+    return ax.update(x, dt, q, r), ay.update(y, dt, q, r), az.update(z, dt, q, r)
+
+class MotionPredictor(object):
+  '''
+  Extrapolates position from recent samples
+
+  The poller appends every published position as a (t, x, y, z)
+  tuple. predict() fits a straight line through the samples of the last
+  window seconds and extends it to the requested time, at most
+  horizon seconds past the newest sample, so a stale hand is not
+  sent flying off. Results are clamped to the 0.0 to 1.0 range.
+
+  Samples are stored as whole tuples in a bounded deque, and
+  predict() copies it in one step, so no lock is needed. append
+  is the deque's own, so the poller pays one C call per sample.
+  '''
+  def __init__(self, size=SW_PREDICT_SAMPLES, window=SW_PREDICT_WINDOW, horizon=SW_PREDICT_HORIZON):
+    self.window = window
+    self.horizon = horizon
+    self.samples = collections.deque(maxlen=size)
+    self.append = self.samples.append
+
+  def predict(self, t_future):
+    samples = tuple(self.samples)
+    if len(samples) == 0:
+      return 0.0, 0.0, 0.0
+
+    newest = max(samples)
+    recent = [sample for sample in samples if newest[0] - sample[0] <= self.window]
+    if len(recent) < 2:
+      return newest[1:]
+
+    n = float(len(recent))
+    mt = sum(sample[0] for sample in recent) / n
+    mx = sum(sample[1] for sample in recent) / n
+    my = sum(sample[2] for sample in recent) / n
+    mz = sum(sample[3] for sample in recent) / n
+
+    stt = sum((sample[0] - mt) ** 2 for sample in recent)
+    if stt <= 0.0:
+      return mx, my, mz
+    vx = sum((sample[0] - mt) * (sample[1] - mx) for sample in recent) / stt
+    vy = sum((sample[0] - mt) * (sample[2] - my) for sample in recent) / stt
+    vz = sum((sample[0] - mt) * (sample[3] - mz) for sample in recent) / stt
+
+    ahead = min(max(t_future, newest[0]), newest[0] + self.horizon) - mt
+    return (
+      min(max(mx + vx * ahead, 0.0), 1.0),
+      min(max(my + vy * ahead, 0.0), 1.0),
+      min(max(mz + vz * ahead, 0.0), 1.0)
+    )
+
+class AirWheel(object):
+  '''
+  Unwrapped airwheel rotation and angular velocity
+
+  The AirWheelInfo counter moves SW_AIRWHEEL_STEPS per turn,
+  up for clockwise, and wraps at 256. Each frame's change is
+  taken as the shortest signed step, so turns accumulate without
+  limit in either direction. Frames are 5ms apart, so a step can
+  only be misread if the hand turns four times in one frame.
+  When the wheel goes inactive the velocity drops to 0, and the
+  next active frame only sets a new reference, so nothing jumps.
+
+  state is (rotation, velocity, timestamp), rotation in degrees
+  clockwise since start, velocity in degrees per second smoothed
+  over about SW_AIRWHEEL_TAU seconds and timestamp the host time
+  of the last change. The poller rebinds it whole, like Snapshot.
+  '''
+  def __init__(self, tau=SW_AIRWHEEL_TAU):
+    self.tau = tau
+    self.active = False
+    self.state = (0.0, 0.0, 0.0)
+    self._counter = 0
+    self._ticks = 0
+    self._dt = 0.0
+    self._alpha = 0.0
+
+  def update(self, counter, ticks, timestamp):
+    '''
+    Take one active frame, returns the change in degrees
+    '''
+    if not self.active:
+      self.active = True
+      self._counter = counter
+      self._ticks = ticks
+      return 0.0
+    if counter == self._counter and not self.state[1]:
+      # A wheel at rest, nothing moved and nothing to smooth
+      self._ticks = ticks
+      return 0.0
+
+    steps = ((counter - self._counter + 128) & 0xff) - 128
+    dt = ((ticks - self._ticks) & 0xff) * 0.005
+    self._counter = counter
+    self._ticks = ticks
+
+    rotation, velocity, changed = self.state
+    delta = steps * 360.0 / SW_AIRWHEEL_STEPS
+    if dt > 0:
+      if dt != self._dt:
+        # Frames are nearly always 5ms apart, keep the last factor
+        self._dt = dt
+        self._alpha = 1.0 - math.exp(-dt / self.tau)
+      velocity += self._alpha * (delta / dt - velocity)
+    if delta or velocity:
+      self.state = (rotation + delta, velocity, timestamp)
+    return delta
+
+  def stop(self, timestamp):
+    self.active = False
+    self.state = (self.state[0], 0.0, timestamp)
+
+class Health(object):
+  '''
+  Firmware, status and SystemInfo counters for one device
+
+  firmware: the last FW_Version_Info the chip sent, or None
+    valid: True if FwValid reports valid firmware (0xAA)
+    hw_rev, param_start, loader_version, fw_start: as sent
+    version: the version string, cut short as a single SMBus
+      read only carries its first 20 characters
+    timestamp: host time it was read
+  status: the last System_Status, or None
+    msg_id: the message it answers
+    max_cmd_size, error: as sent, error 0 means success
+    timestamp: host time it was read
+  status_errors: System_Status messages with a non-zero error
+  noise_frames, clipping_frames: sensor frames with
+    EnvironmentalNoise or Clipping set
+  dsp_stopped_frames: sensor frames with DSPRunning clear
+  dsp_stops: times DSPRunning went from set to clear
+  dsp_stopped_at: host time it last did
+  handler_errors: exceptions raised by event handlers, each is
+    printed and the next handler still runs
+
+  The poller only calls sysinfo() for frames where one of those
+  flags is out of the ordinary, or the one after, so a healthy
+  sensor costs one comparison per frame.
+  '''
+  def __init__(self):
+    self.firmware = None
+    self.status = None
+    self.status_errors = 0
+    self.noise_frames = 0
+    self.clipping_frames = 0
+    self.dsp_stopped_frames = 0
+    self.dsp_stops = 0
+    self.dsp_stopped_at = 0.0
+    self.dsp_running = True
+    self.handler_errors = 0
+    self.abnormal = False
+    self.replies = {
+      SW_FW_VERSION:    threading.Event(),
+      SW_SYSTEM_STATUS: threading.Event()
+    }
+
+  def sysinfo(self, flags, timestamp):
+    if flags & SW_SYSINFO_NOISE:
+      self.noise_frames += 1
+    if flags & SW_SYSINFO_CLIPPING:
+      self.clipping_frames += 1
+    if flags & SW_SYSINFO_DSP:
+      self.dsp_running = True
+    else:
+      self.dsp_stopped_frames += 1
+      if self.dsp_running:
+        self.dsp_stops += 1
+        self.dsp_stopped_at = timestamp
+      self.dsp_running = False
+    self.abnormal = flags != SW_SYSINFO_DSP
+
+  def set_firmware(self, firmware):
+    self.firmware = firmware
+    self.replies[SW_FW_VERSION].set()
+
+  def set_status(self, status):
+    if status['error'] != 0:
+      self.status_errors += 1
+    self.status = status
+    self.replies[SW_SYSTEM_STATUS].set()
+
+  def get(self):
+    return {
+      'firmware':           self.firmware,
+      'status':             self.status,
+      'status_errors':      self.status_errors,
+      'noise_frames':       self.noise_frames,
+      'clipping_frames':    self.clipping_frames,
+      'dsp_running':        self.dsp_running,
+      'dsp_stopped_frames': self.dsp_stopped_frames,
+      'dsp_stops':          self.dsp_stops,
+      'dsp_stopped_at':     self.dsp_stopped_at,
+      'handler_errors':     self.handler_errors
+    }
+
+class Watchdog(object):
+  '''
+  Fault detection settings and recovery record for one device
+
+  A device counts as faulty when reading it raises, when no
+  message arrives for silence seconds, or when DSPRunning stays
+  clear for dsp_timeout seconds. Silence is not checked while
+  approach detection is on, as the chip then stops sending
+  between approaches. With auto_recover set it is
+  then reset and reconfigured on a background thread, waiting
+  delay seconds before the first attempt and twice as long
+  before each retry, up to max_delay, and giving up after
+  attempts tries. Other devices, and the application, carry on
+  meanwhile. The backoff only starts over once a recovered device
+  has kept reading with DSPRunning set for dsp_timeout seconds,
+  or when recover() is called by hand, so a fault that survives
+  resets still ends in 'failed'.
+
+  state: 'ok', 'recovering' or 'failed'
+  faults: faults seen, by kind, 'bus' for I/O errors, 'error'
+    for any other exception, 'silence' and 'dsp'
+  last_fault: (kind, description, host time) or None
+  recoveries: successful recoveries
+  recovered_at: host time of the last successful recovery
+  tries: recovery attempts since the device was last healthy
+  '''
+  def __init__(self, silence=SW_WATCHDOG_SILENCE, dsp_timeout=SW_WATCHDOG_DSP,
+               delay=SW_RECOVERY_DELAY, max_delay=SW_RECOVERY_MAX_DELAY, attempts=SW_RECOVERY_ATTEMPTS):
+    self.silence = silence
+    self.dsp_timeout = dsp_timeout
+    self.delay = delay
+    self.max_delay = max_delay
+    self.attempts = attempts
+    self.state = 'ok'
+    self.faults = {}
+    self.last_fault = None
+    self.recoveries = 0
+    self.recovered_at = 0.0
+    self.tries = 0
+
+  def fault(self, kind, description):
+    self.faults[kind] = self.faults.get(kind, 0) + 1
+    self.last_fault = (kind, description, time.time())
+
+  def backoff(self):
+    '''
+    Return the wait before the next attempt, or None to give up
+    '''
+    if self.tries >= self.attempts:
+      return None
+    return min(self.delay * 2 ** self.tries, self.max_delay)
+
+  def get(self):
+    return {
+      'state':        self.state,
+      'faults':       dict(self.faults),
+      'last_fault':   self.last_fault,
+      'recoveries':   self.recoveries,
+      'recovered_at': self.recovered_at,
+      'tries':        self.tries
+    }
+
+class TransferPlanner(object):
+  '''
+  Decides how many bytes each read of the MGC3130 transfers
+
+  Sensor data messages only carry the fields enabled in the
+  DataOutputConfigMask, so reads are sized from the mask the chip
+  was configured with rather than a fixed 26 bytes. After a
+  command that the chip answers, expect_reply() widens reads to
+  SW_MAX_MSG_SIZE until a reply arrives or SW_REPLY_TIMEOUT passes.
+  If the chip reports a sensor message size other than planned,
+  the plan follows the chip from the next read on.
+
+  Each TS assertion carries exactly one message, so there is
+  nothing to batch, bus_hz is used to estimate how long a read
+  holds TS low, see transfer_time().
+  '''
+  def __init__(self, mask=SW_OUTPUT_MASK, bus_hz=SW_I2C_HZ):
+    self.bus_hz = bus_hz
+    self.replies = 0
+    self.reply_until = 0.0
+    self.set_mask(mask)
+
+  def set_mask(self, mask):
+    self.mask = mask
+    self.size = min(sensor_layout(mask)[1], SW_MAX_MSG_SIZE)
+
+  def expect_reply(self):
+    self.replies += 1
+    self.reply_until = time.time() + SW_REPLY_TIMEOUT
+
+  def next_size(self):
+    if self.replies > 0:
+      if time.time() < self.reply_until:
+        return SW_MAX_MSG_SIZE
+      self.replies = 0
+    return self.size
+
+  def received(self, ident, size):
+    if ident == SW_SENSOR_DATA:
+      if size != self.size and SW_HEADER_SIZE < size <= SW_MAX_MSG_SIZE:
+        self.size = size
+    elif self.replies > 0:
+      self.replies -= 1
+
+  def transfer_time(self, size):
+    # Address byte plus data, 9 clocks each including the ACK
+    return (size + 1) * 9.0 / self.bus_hz
+
+'''
+A decoded event, kind is the handler type ('move', 'flick',
+'touch', 'tap', 'doubletap', 'airwheel' ...), args are what that
+handler would be called with, timestamp is the host time the
+frame was read and device is the Skywriter it came from
+'''
+Event = collections.namedtuple('Event', 'kind args timestamp device')
+
+class EventQueue(object):
+  '''
+  Bounded, thread-safe queue of Events
+
+  overflow decides what happens when a new event arrives and
+  the queue is full:
+    'drop-oldest' - discard the oldest queued event
+    'drop-newest' - discard the new event
+  Either way the loss is counted in dropped.
+
+  Kinds listed in coalesce never queue behind themselves, a new
+  one from the same device replaces one that is still waiting,
+  so a slow consumer only ever sees the latest position.
+
+  on_put, if set, is called on the producer's thread after each
+  put() so a consumer on another thread or event loop can be woken.
+  '''
+  def __init__(self, maxsize=64, overflow='drop-oldest', coalesce=('move',)):
+    if overflow not in ('drop-oldest', 'drop-newest'):
+      raise ValueError("overflow must be 'drop-oldest' or 'drop-newest'")
+    self.maxsize = maxsize
+    self.overflow = overflow
+    self.coalesce = frozenset(coalesce)
+    self.dropped = 0
+    self.on_put = None
+    self._items = collections.deque()
+    self._waiting = {}
+    self._cond = threading.Condition(threading.Lock())
+
+  def __len__(self):
+    return len(self._items)
+
+  def put(self, event):
+    with self._cond:
+      key = (event.kind, event.device)
+      cell = self._waiting.get(key)
+      if cell != None:
+        cell[0] = event
+      else:
+        if len(self._items) >= self.maxsize:
+          self.dropped += 1
+          if self.overflow == 'drop-newest':
+            return
+          self._forget(self._items.popleft())
+        cell = [event]
+        self._items.append(cell)
+        if event.kind in self.coalesce:
+          self._waiting[key] = cell
+      self._cond.notify()
+    if self.on_put != None:
+      self.on_put()
+
+  def get(self, timeout=None):
+    '''
+    Return the next Event, or None if none arrives within timeout
+    '''
+    with self._cond:
+      if len(self._items) == 0:
+        self._cond.wait(timeout)
+      return self._pop()
+
+  def get_nowait(self):
+    with self._cond:
+      return self._pop()
+
+  def _pop(self):
+    if len(self._items) == 0:
+      return None
+    cell = self._items.popleft()
+    self._forget(cell)
+    return cell[0]
+
+  def _forget(self, cell):
+    key = (cell[0].kind, cell[0].device)
+    if self._waiting.get(key) is cell:
+      del self._waiting[key]
+
+class EventStream(object):
+  '''
+  Async iterator over skywriter events, see events()
+
+  The poller feeds the EventQueue from its own thread and wakes
+  the event loop with call_soon_threadsafe, so nothing on the
+  loop ever waits on the bus.
+  '''
+  def __init__(self, device, loop, maxsize=64, overflow='drop-oldest', coalesce=('move',)):
+    self.device = device
+    self.loop = loop
+    self.queue = EventQueue(maxsize, overflow, coalesce)
+    self.queue.on_put = self._wake
+    self.closed = False
+    self._waiter = None
+
+  def __aiter__(self):
+    return self
+
+  def __anext__(self):
+    future = self.loop.create_future()
+    event = self.queue.get_nowait()
+    if event != None:
+      future.set_result(event)
+    elif self.closed:
+      future.set_exception(StopAsyncIteration())
+    else:
+      self._waiter = future
+    return future
+
+  def _wake(self):
+    if not self.loop.is_closed():
+      self.loop.call_soon_threadsafe(self._deliver)
+
+  def _deliver(self):
+    waiter = self._waiter
+    if waiter == None or waiter.done():
+      return
+    event = self.queue.get_nowait()
+    if event != None:
+      self._waiter = None
+      waiter.set_result(event)
+
+  def close(self):
+    '''
+    Stop receiving events, a pending iteration ends cleanly
+    '''
+    self.device._close_stream(self)
+    self.closed = True
+    waiter = self._waiter
+    if waiter != None and not waiter.done():
+      self._waiter = None
+      waiter.set_exception(StopAsyncIteration())
+
+class _WeakHandler(object):
+  '''
+  Calls a handler held by weak reference
+
+  Bound methods are split into their function and a weak
+  reference to their object, as the bound method itself is
+  a temporary. collected(self) is called once the target is gone.
+  '''
+  def __init__(self, handler, collected):
+    self.func = getattr(handler, '__func__', None)
+    target = getattr(handler, '__self__', None)
+    if self.func == None or target == None:
+      self.func = None
+      target = handler
+    self.collected = collected
+    self.ref = weakref.ref(target, self._dead)
+
+  def _dead(self, ref):
+    self.collected(self)
+
+  def target(self):
+    target = self.ref()
+    if target == None or self.func == None:
+      return target
+    return types.MethodType(self.func, target)
+
+  def __call__(self, *args):
+    target = self.ref()
+    if target == None:
+      return
+    if self.func == None:
+      target(*args)
+    else:
+      self.func(target, *args)
+
+class HandlerRegistry(object):
+  '''
+  A device's event handlers, with a precomputed dispatch table
+
+  Any number of handlers can subscribe to each kind of event.
+  Touch, tap and doubletap handlers subscribe to one position,
+  and are called with no arguments, or to 'all' positions and
+  are called with the position. Every other handler is called
+  with the event's args.
+
+  Gesture handlers are called with the gesture's directions, as
+  they always were, or with details set, with the edge flag and
+  the host timestamp after them.
+
+  routes maps an event kind, or (kind, position) for touch
+  events, straight to a tuple of (handler, arity) pairs, where
+  arity is how many of the event's args the handler takes, or
+  None for all of them. It is rebuilt on each change and swapped
+  in whole, so dispatch reads it without a lock.
+
+  Handlers subscribed with weak=True are held by weak reference,
+  so an overlay can subscribe its own methods and simply be
+  thrown away. Collection only marks the registry dirty, as it
+  can happen on any thread at any point, even while this thread
+  holds the lock. Collected handlers are dropped by the next
+  subscribe(), unsubscribe() or collect(). on_change is called
+  whenever the set of handlers changes.
+  '''
+  def __init__(self, on_change=None):
+    self.on_change = on_change
+    self.routes = {}
+    self.dirty = False
+    self._subscriptions = []
+    self._lock = threading.Lock()
+
+  def subscribe(self, kind, handler, position=None, weak=False, details=False):
+    if kind in _TOUCH_KINDS and position == None:
+      position = 'all'
+    if weak:
+      handler = _WeakHandler(handler, self._collected)
+    with self._lock:
+      self._subscriptions = self._alive() + [(kind, position, handler, details)]
+      self._rebuild()
+    self._changed()
+
+  def unsubscribe(self, handler, kind=None, position=None):
+    '''
+    Remove handler from kind and position, or from everything
+
+    Returns the number of subscriptions removed.
+    '''
+    def matches(subscription):
+      s_kind, s_position, s_handler, s_details = subscription
+      if kind != None and s_kind != kind:
+        return False
+      if position != None and s_position != position:
+        return False
+      if isinstance(s_handler, _WeakHandler):
+        s_handler = s_handler.target()
+      return s_handler == handler
+
+    with self._lock:
+      alive = self._alive()
+      self._subscriptions = [sub for sub in alive if not matches(sub)]
+      count = len(alive) - len(self._subscriptions)
+      self._rebuild()
+    if count:
+      self._changed()
+    return count
+
+  def kinds(self):
+    '''
+    Return the set of event kinds that have handlers
+    '''
+    return set(subscription[0] for subscription in self._subscriptions)
+
+  def collect(self):
+    '''
+    Drop handlers whose targets have been collected
+    '''
+    if not self.dirty:
+      return
+    with self._lock:
+      count = len(self._subscriptions)
+      self._subscriptions = self._alive()
+      count -= len(self._subscriptions)
+      self._rebuild()
+    if count:
+      self._changed()
+
+  def _collected(self, weak_handler):
+    # Run by the garbage collector, taking the lock here could deadlock
+    self.dirty = True
+
+  def _alive(self):
+    self.dirty = False
+    return [sub for sub in self._subscriptions
+            if not isinstance(sub[2], _WeakHandler) or sub[2].ref() != None]
+
+  def _rebuild(self):
+    routes = {}
+    for kind, position, handler, details in self._subscriptions:
+      arity = None
+      if kind in _TOUCH_KINDS:
+        if position == 'all':
+          keys = [(kind, p) for p in _TOUCH_POSITIONS]
+        else:
+          arity = 0
+          keys = [(kind, position)]
+      else:
+        if kind in _GESTURE_ARITY and not details:
+          arity = _GESTURE_ARITY[kind]
+        keys = [kind]
+      for key in keys:
+        routes[key] = routes.get(key, ()) + ((handler, arity),)
+    self.routes = routes
+
+  def _changed(self):
+    if self.on_change != None:
+      self.on_change()
+
+class SimulatedMGC3130(object):
+  '''
+  In-process stand-in for the MGC3130 and its GPIO lines
+
+  A single instance acts as both the I2C bus and the GPIO
+  module, so it can be passed to use_backend(sim, sim).
+
+  Sensor data (0x91) messages are produced on a fixed schedule
+  of rate messages per second, the TS line reads low whenever
+  one is due and wait_for_edge() sleeps until the next one.
+  Callbacks given to add_event_detect() are run from a thread of
+  its own each time the line goes low.
+  A rate of 0 produces messages as fast as they are read.
+  Firmware info (0x83) and system status (0x15) messages are
+  queued in response to SW_REQUEST_MSG writes.
+
+  If the host falls behind, missed messages are skipped and
+  the sequence number jumps, just like the real chip.
+
+  inject_fault() makes it misbehave, to exercise Watchdog.
+  '''
+  BCM     = 11
+  OUT     = 0
+  IN      = 1
+  LOW     = 0
+  HIGH    = 1
+  PUD_UP  = 22
+  RISING  = 31
+  FALLING = 32
+
+  def __init__(self, rate=200.0, xfer_pin=SW_XFER_PIN, reset_pin=SW_RESET_PIN, seed=None,
+               gesture_every=400, touch_every=300):
+    self.rate = float(rate)
+    self.xfer_pin = xfer_pin
+    self.reset_pin = reset_pin
+    self.gesture_every = gesture_every
+    self.touch_every = touch_every
+    self.random = random.Random(seed)
+    self.config = None
+    self.output_mask = SW_OUTPUT_MASK
+    self.runtime = {}
+    self.frames_sent = 0
+    self.faults = {}
+    self._lock = threading.Lock()
+    self._changed = threading.Condition(self._lock)
+    self._callbacks = {}
+    self._edges = None
+    self._responses = []
+    self._reset_state()
+
+  def inject_fault(self, kind, resets=1):
+    '''
+    Misbehave until reset resets times, or until clear_fault()
+
+    kind is one of
+      'silence' - TS stays high, no messages are sent
+      'bus' - every I2C transfer raises IOError
+      'dsp' - sensor messages report DSPRunning clear
+    resets of None keeps the fault through any number of resets.
+    '''
+    with self._lock:
+      self.faults[kind] = resets
+      self._changed.notify_all()
+
+  def clear_fault(self, kind=None):
+    with self._lock:
+      if kind == None:
+        self.faults = {}
+      else:
+        self.faults.pop(kind, None)
+      self._changed.notify_all()
+
+  def _bus_fault(self):
+    if 'bus' in self.faults:
+      raise IOError(5, 'Input/output error')
+
+  def _reset_state(self):
+    self._seq = 0
+    self._start = time.time()
+    self._due = self._start
+    self.output_mask = SW_OUTPUT_MASK
+
+  def _period(self):
+    if self.rate <= 0:
+      return 0.0
+    return 1.0 / self.rate
+
+  def _ready(self):
+    if 'silence' in self.faults:
+      return False
+    return len(self._responses) > 0 or time.time() >= self._due
+
+  # GPIO interface
+
+  def setmode(self, mode):
+    pass
+
+  def setup(self, pin, direction, initial=None, pull_up_down=None):
+    pass
+
+  def output(self, pin, value):
+    if pin == self.reset_pin and value == self.HIGH:
+      with self._lock:
+        self._responses = []
+        self._reset_state()
+        for kind, resets in list(self.faults.items()):
+          if resets != None:
+            if resets <= 1:
+              del self.faults[kind]
+            else:
+              self.faults[kind] = resets - 1
+        self._changed.notify_all()
+
+  def input(self, pin):
+    if pin == self.xfer_pin and self._ready():
+      return self.LOW
+    return self.HIGH
+
+  def wait_for_edge(self, pin, edge, timeout=None):
+    now = time.time()
+    wake = self._due
+    if 'silence' in self.faults:
+      wake = float('inf')
+    if timeout is not None:
+      wake = min(wake, now + timeout / 1000.0)
+    if wake > now:
+      time.sleep(wake - now)
+    if pin == self.xfer_pin and self._ready():
+      return pin
+    return None
+
+  def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+    with self._lock:
+      if pin in self._callbacks:
+        raise RuntimeError('Conflicting edge detection already enabled for this GPIO channel')
+      self._callbacks[pin] = callback
+      if self._edges == None:
+        self._edges = threading.Thread(target=self._do_edges)
+        self._edges.daemon = True
+        self._edges.start()
+      self._changed.notify_all()
+
+  def remove_event_detect(self, pin):
+    with self._lock:
+      self._callbacks.pop(pin, None)
+      self._changed.notify_all()
+
+  def _do_edges(self):
+    '''
+    Run the edge callbacks each time the TS line goes low
+    '''
+    low = False
+    while True:
+      with self._lock:
+        if self.xfer_pin not in self._callbacks:
+          self._edges = None
+          return
+        ready = self._ready()
+        callback = self._callbacks[self.xfer_pin] if ready and not low else None
+        low = ready
+        if callback == None:
+          timeout = None
+          if not ready and 'silence' not in self.faults and not math.isinf(self._due):
+            timeout = max(0.0, self._due - time.time())
+          self._changed.wait(timeout)
+      if callback != None:
+        callback(self.xfer_pin)
+
+  def cleanup(self, channel=None):
+    pass
+
+  # I2C interface
+
+  def read_i2c_block_data(self, addr, cmd, length=32):
+    self._bus_fault()
+    with self._lock:
+      if len(self._responses) > 0:
+        msg = self._responses.pop(0)
+      else:
+        msg = self._next_message()
+      self._changed.notify_all()
+    msg = msg[:length]
+    return msg + [0] * (length - len(msg))
+
+  def write_i2c_block_data(self, addr, cmd, data):
+    self._bus_fault()
+    msg = [cmd] + list(data)
+    if len(msg) > 4 and msg[3] == SW_REQUEST_MSG:
+      with self._lock:
+        if msg[4] == SW_FW_VERSION:
+          self._responses.append(self._firmware_message())
+        elif msg[4] == SW_SYSTEM_STATUS:
+          self._responses.append(self._status_message(SW_REQUEST_MSG, 0))
+        self._changed.notify_all()
+    elif len(msg) == _SET_RUNTIME.size and msg[3] == SW_SET_RUNTIME:
+      size, flags, seq, ident, param, arg0, arg1 = _SET_RUNTIME.unpack(bytearray(msg))
+      with self._lock:
+        self.runtime[param] = (arg0, arg1)
+        if param == SW_PARAM_DATA_OUTPUT_ENABLE:
+          self.output_mask = (self.output_mask & ~arg1) | (arg0 & arg1)
+        self._responses.append(self._status_message(SW_SET_RUNTIME, 0))
+        self._changed.notify_all()
+    else:
+      self.config = msg
+
+  # Message generation
+
+  def _next_message(self):
+    return self._sensor_message()
+
+  def _next_seq(self):
+    self._seq = (self._seq + 1) & 0xff
+    return self._seq
+
+  def _status_message(self, msg_id, error):
+    return [16, 0, self._next_seq(), SW_SYSTEM_STATUS,
+            msg_id, 0, error & 0xff, error >> 8,
+            0, 0, 0, 0, 0, 0, 0, 0]
+
+  def _firmware_message(self):
+    version = '1.3.14;p:HillstarV01;x:Hillstar;DSP:ID9000r2963;i:B;f:22500;nMsg;s:Rel_1_3_14'
+    version = [ord(c) for c in version] + [0] * (120 - len(version))
+    return [132, 0, self._next_seq(), SW_FW_VERSION,
+            0xaa, 0x02, 0x00, 0x00, 0x01, 0x02, 0x03, 0x00] + version
+
+  def _sensor_message(self):
+    period = self._period()
+    now = time.time()
+    if period > 0:
+      missed = int((now - self._due) / period)
+      if missed > 0:
+        self._seq = (self._seq + missed) & 0xff
+        self._due += missed * period
+      self._due += period
+
+    n = self.frames_sent
+    self.frames_sent += 1
+    t = now - self._start
+
+    pos_x = int((0.5 + 0.4 * math.sin(t * 1.6)) * 65535)
+    pos_y = int((0.5 + 0.4 * math.sin(t * 2.3)) * 65535)
+    pos_z = int((0.5 + 0.3 * math.sin(t * 0.7)) * 65535)
+
+    sysinfo = 0b10000001 # DSPRunning, PositionValid
+    if (n // 1000) % 2:
+      sysinfo |= 0b00000010 # AirWheelValid
+    if 'dsp' in self.faults:
+      sysinfo &= ~SW_SYSINFO_DSP
+
+    gesture = 0
+    gesture_class = 0
+    edge = 0
+    if self.gesture_every and n % self.gesture_every == self.gesture_every - 1:
+      gesture = (n // self.gesture_every) % 7 + 1
+      gesture_class = (0, 1, 1, 1, 1, 2, 2)[gesture - 1]
+      if gesture_class == 1:
+        edge = self.random.randint(0, 1)
+
+    action = 0
+    if self.touch_every and n % self.touch_every == self.touch_every - 1:
+      action = 1 << ((n // self.touch_every) % 15)
+
+    fields = {
+      SW_DATA_DSP:      [0, 0],
+      SW_DATA_GESTURE:  [gesture, gesture_class << 4, edge, 0],
+      SW_DATA_TOUCH:    [action & 0xff, action >> 8, self.random.randint(0, 20), 0],
+      SW_DATA_AIRWHEEL: [int(t * 16) & 0xff, 0],
+      SW_DATA_XYZ:      [pos_x & 0xff, pos_x >> 8, pos_y & 0xff, pos_y >> 8, pos_z & 0xff, pos_z >> 8],
+      SW_DATA_NOISE:    [0, 0, 0, 0]
+    }
+
+    mask = self.output_mask
+    payload = [mask & 0xff, mask >> 8, int(t * 200) & 0xff, sysinfo]
+    for bit, size in _SENSOR_FIELDS:
+      if mask & bit:
+        payload += fields[bit]
+
+    return [SW_HEADER_SIZE + len(payload), 0, self._next_seq(), SW_SENSOR_DATA] + payload
+
+class CaptureWriter(object):
+  '''
+  Appends raw messages to a capture file
+
+  Safe to close from another thread while the poller is writing,
+  records written after close() are silently discarded.
+  '''
+  def __init__(self, path):
+    self.path = path
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+      capture = CaptureFile(path)
+      end = capture._offset(len(capture))
+      capture.close()
+      if os.path.getsize(path) > end:
+        # Cut off a record left half written, or every record
+        # appended after it would be read out of step
+        with io.open(path, 'r+b') as f:
+          f.truncate(end)
+    self._lock = threading.Lock()
+    self.file = io.open(path, 'ab')
+    if self.file.tell() == 0:
+      self.file.write(_CAPTURE_HEADER.pack(SW_CAPTURE_MAGIC, SW_CAPTURE_VERSION, _CAPTURE_RECORD.size))
+
+  def write(self, timestamp, data):
+    length = min(len(data), SW_MAX_MSG_SIZE)
+    record = _CAPTURE_RECORD.pack(timestamp, length, bytes(bytearray(data[:length])))
+    with self._lock:
+      if self.file != None:
+        self.file.write(record)
+
+  def close(self):
+    with self._lock:
+      if self.file != None:
+        self.file.close()
+        self.file = None
+
+class CaptureFile(object):
+  '''
+  Memory-mapped, random access reader for capture files
+
+  capture[i] returns (timestamp, message) for record i, where
+  message is a list of byte values just as SMBus returns it.
+  Records are read straight from the map, so captures of any
+  length open instantly. Records appended after opening are not
+  visible.
+  '''
+  def __init__(self, path):
+    self.path = path
+    self.file = io.open(path, 'rb')
+    self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, size = _CAPTURE_HEADER.unpack_from(self.map, 0)
+    if magic != SW_CAPTURE_MAGIC or version != SW_CAPTURE_VERSION or size != _CAPTURE_RECORD.size:
+      self.close()
+      raise ValueError("%s is not a skywriter capture" % path)
+    self.count = (len(self.map) - _CAPTURE_HEADER.size) // _CAPTURE_RECORD.size
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, index):
+    if index < 0:
+      index += self.count
+    if index < 0 or index >= self.count:
+      raise IndexError("capture record out of range")
+    timestamp, length, data = _CAPTURE_RECORD.unpack_from(self.map, self._offset(index))
+    return timestamp, list(bytearray(data[:length]))
+
+  def _offset(self, index):
+    return _CAPTURE_HEADER.size + index * _CAPTURE_RECORD.size
+
+  def timestamp(self, index):
+    return struct.unpack_from('<d', self.map, self._offset(index))[0]
+
+  def find(self, timestamp):
+    '''
+    Return the index of the first record at or after timestamp
+    '''
+    lo, hi = 0, self.count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.timestamp(mid) < timestamp:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def close(self):
+    self.map.close()
+    self.file.close()
+
+class ReplayMGC3130(SimulatedMGC3130):
+  '''
+  Plays a capture file back through the normal decode path
+
+  capture is a CaptureFile or a path to one. With realtime set,
+  messages are released with their recorded spacing, divided by
+  speed. Otherwise each is available as soon as the previous one
+  has been read. With loop set, playback restarts at start when
+  it reaches the end, otherwise the TS line stays high and
+  finished is set.
+
+  Recorded messages are renumbered to follow on from the replies
+  to commands sent before and during playback, so those replies
+  do not show up as dropped frames while gaps in the capture
+  still do.
+  '''
+  def __init__(self, capture, realtime=True, speed=1.0, loop=False, start=0, **kwargs):
+    if not isinstance(capture, CaptureFile):
+      capture = CaptureFile(capture)
+    self.capture = capture
+    self.realtime = realtime
+    self.speed = float(speed)
+    self.loop = loop
+    self.start = start
+    SimulatedMGC3130.__init__(self, rate=0, **kwargs)
+
+  def _reset_state(self):
+    SimulatedMGC3130._reset_state(self)
+    self.index = self.start
+    self._shift = 0
+    self.finished = self.start >= len(self.capture)
+    if self.finished:
+      self._due = float('inf')
+    else:
+      self._origin = self.capture.timestamp(self.start)
+
+  def _next_message(self):
+    if self.finished:
+      return []
+
+    if self.index == self.start:
+      # The playback clock starts when the first message is read
+      self._start = time.time()
+
+    timestamp, msg = self.capture[self.index]
+    if len(msg) > 2:
+      if self.index == self.start:
+        # Carry on from whatever the chip sent before playback
+        self._shift = self._seq + 1 - msg[2]
+      msg[2] = self._seq = (msg[2] + self._shift) & 0xff
+    self.index += 1
+    self.frames_sent += 1
+
+    if self.index >= len(self.capture):
+      if not self.loop:
+        self.finished = True
+        self._due = float('inf')
+      else:
+        self.index = self.start
+      return msg
+
+    if self.realtime:
+      self._due = self._start + (self.capture.timestamp(self.index) - self._origin) / self.speed
+
+    return msg
+
+  def _next_seq(self):
+    self._shift += 1
+    return SimulatedMGC3130._next_seq(self)
+
+class Scheduler(object):
+  '''
+  Polls any number of Skywriter devices from one thread
+
+  Every device's TS edge callback sets the same event, so the
+  thread sleeps until any of the lines drops. With a single
+  device it waits on that device's TS, exactly as before. With
+  several it reads every TS line in turn, services each device
+  whose line is low, and sleeps on the event when none is. A new
+  device costs one GPIO read per pass rather than another thread
+  waking up. Should a device have no edge detection the thread
+  falls back to sleeping SW_POLL_INTERVAL between passes.
+
+  Handlers for all of its devices run on one dispatcher thread,
+  fed by a single EventQueue.
+
+  Every device shares one Scheduler unless given its own. Devices
+  on the same bus can only be read one after another anyway, so
+  giving each bus its own Scheduler lets the buses be read in
+  parallel.
+  '''
+  def __init__(self):
+    self.devices = []
+    self.worker = None
+    self.dispatcher = None
+    self.queue = EventQueue(maxsize=SW_DISPATCH_QUEUE, coalesce=('move',))
+    self._lock = threading.Lock()
+    self._busy = threading.Lock()
+    self._wake = threading.Event()
+    self._next_check = 0.0
+
+  def add(self, device):
+    with self._lock:
+      if device in self.devices:
+        return
+      self.devices = self.devices + [device]
+      device.polling = True
+      device._edge = self._wake
+      if device.threaded_dispatch:
+        device._dispatch = self.queue
+        if self.dispatcher == None:
+          self.dispatcher = AsyncWorker(self._do_dispatch)
+          self.dispatcher.start()
+      if self.worker == None:
+        self.worker = AsyncWorker(self._do_poll)
+        self.worker.start()
+
+  def remove(self, device):
+    '''
+    Stop polling device, once this returns it is not being read
+    '''
+    with self._lock:
+      if device not in self.devices:
+        return
+      self.devices = [other for other in self.devices if other is not device]
+      device.polling = False
+      device._dispatch = None
+      device._edge = threading.Event()
+      worker = dispatcher = None
+      if len(self.devices) == 0:
+        worker, dispatcher = self.worker, self.dispatcher
+        self.worker = self.dispatcher = None
+
+    if worker != None:
+      worker.stop()
+      if dispatcher != None:
+        dispatcher.stop()
+    else:
+      # Wait out a pass that may still be reading it
+      with self._busy:
+        pass
+
+  def _do_poll(self):
+    with self._busy:
+      devices = self.devices
+      serviced = True
+      if len(devices) == 1:
+        self._run(devices[0], devices[0]._poll)
+      else:
+        # Edges from here on, even during this pass, end the wait below
+        self._wake.clear()
+        serviced = False
+        for device in devices:
+          if self._run(device, device._service):
+            serviced = True
+
+      now = time.time()
+      if now >= self._next_check:
+        self._next_check = now + SW_WATCHDOG_INTERVAL
+        for device in devices:
+          device._check(now)
+
+    if not serviced:
+      if all(device._watching for device in devices):
+        self._wake.wait(SW_XFER_TIMEOUT / 1000.0)
+      else:
+        time.sleep(SW_POLL_INTERVAL)
+
+  def _run(self, device, step):
+    '''
+    Run one polling step, an exception faults that device only
     '''
-    GPIO.setup(SW_XFER_PIN, GPIO.OUT, initial=GPIO.LOW)
-    data = i2c.read_i2c_block_data(SW_ADDR, 0x00, 26)
+    try:
+      return step()
+    except (IOError, OSError) as e:
+      device._fault('bus', e)
+    except Exception as e:
+      device._fault('error', e)
+    return False
+
+  def _do_dispatch(self):
+    event = self.queue.get(SW_XFER_TIMEOUT / 1000.0)
+    if event != None:
+      event.device._deliver(event.kind, event.args, event.timestamp)
+
+_scheduler = Scheduler()
+
+class Skywriter(object):
+  '''
+  One MGC3130 board
+
+  Each device has its own bus, address, pins, handlers, output
+  mask, stats and sample history, so several boards can drive
+  one application:
 
+    left = skywriter.Skywriter(bus=1, addr=0x42)
+    right = skywriter.Skywriter(bus=0, addr=0x42, reset_pin=5, xfer_pin=6)
 
+    @right.move()
+    def steer(x, y, z):
+      ...
+
+  bus is an SMBus number or any object with read_i2c_block_data
+  and write_i2c_block_data, gpio looks like the RPi.GPIO module.
+  Whatever is left as None is picked by SKYWRITER_BACKEND when
+  the device is opened. Polling is done by scheduler, the one
+  shared by all devices if not given, see Scheduler.
+
+  The module level functions act on default_device().
+  '''
+  def __init__(self, bus=None, addr=SW_ADDR, reset_pin=SW_RESET_PIN, xfer_pin=SW_XFER_PIN,
+               gpio=None, scheduler=None):
+    self.bus_id = None
+    self.i2c = None
+    if isinstance(bus, int):
+      self.bus_id = bus
+    else:
+      self.i2c = bus
+    self.GPIO = gpio
+    self.addr = addr
+    self.reset_pin = reset_pin
+    self.xfer_pin = xfer_pin
+    self.scheduler = _scheduler if scheduler == None else scheduler
+
+    self.use_interrupts = use_interrupts
+    self.autostart = autostart
+    self.threaded_dispatch = threaded_dispatch
+    self.auto_mask = auto_mask
+    self.auto_recover = auto_recover
+    self.watchdog = Watchdog()
+
+    self.polling = False
+
+    self._required = 0
+    self._output_mask = 0
+    self._commands = collections.deque()
+    self._opener = None
+    self._ready = threading.Event()
+    self._edge = threading.Event()
+    self._watching = False
+    self.handlers = HandlerRegistry(self._update_mask)
+
+    self._rx_buf = bytearray(SW_MAX_MSG_SIZE)
+    self._latest = Snapshot()
+    self._predictor = MotionPredictor()
+    self._airwheel = AirWheel()
+    self._health = Health()
+    self._runtime = collections.OrderedDict()
+    self._last_read = 0.0
+    self._recovery = None
+    self._planner = TransferPlanner()
+    self._decoder = sensor_decoder(0)
+    self._stats = Stats()
+    self._ring = None
+    self._ring_reader = None
+    self._filter = None
+    self._capture = None
+    self._streams = []
+    self._dispatch = None
+
+  def reset(self):
+    self.GPIO.output(self.reset_pin, self.GPIO.LOW)
+    time.sleep(.1)
+    self.GPIO.output(self.reset_pin, self.GPIO.HIGH)
+    time.sleep(.5) # Datasheet delay of 200ms plus change
+    #time.sleep(3)
+
+  # Decoding
+
+  def handle_sensor_data(self, data, offset=SW_HEADER_SIZE, timestamp=None):
+    '''
+    | HEADER | PAYLOAD
+    |        |  DataOutputConfigMask 2 | TimeStamp 1 | SystemInfo 1 | Content |
+
+    DataOutputConfigMask
+    Bit 0 - DSPStatus
+    Bit 1 - GestureInfo
+    Bit 2 - TouchInfo
+    Bit 3 - AirWheelInfo
+    Bit 4 - XYZ Position
+    Bit 5 - NoisePower
+    Bit 6-7 - Reserved
+    Bit 8-10 - ElectrodeConfiguration
+    Bit 11 - CICData
+    Bit 12 - SDData
+    Bit 13-15 - Reserved
+
+    SystemInfo
+    Bit 0 - PositionValid, indicates xyz pos data is valid
+    Bit 1 - AirWheelValid, indicates AirWheel is active and AirWheelInfo is vaid
+    Bit 2 - RawDataValid, indicates CICData and SDData fields are valid
+    Bit 3 - NoisePowerValid, indicates NoisePower field is valid
+    Bit 4 - EnvironmentalNoise, indicates that environmental noise has been detected
+    Bit 5 - Clipping, indicates that the ADCs are clipping
+    Bit 6 - Reserved
+    Bit 7 - DSPRunning, indicates the system is currently running
+
+    DSPStatus - 2 bytes -
+    GestureInfo - 4 bytes
+    TouchInfo - 4 bytes
+    AirWheelInfo - 2 bytes - first byte indicates rotation, ++ = clockwise, 32 = 1 rotation, wraps at 256
+    xyzPosition - 6 bytes - 1+2 = x, 3-4 = y, 5-6 = z
+    NoisePower
+    CICData
+    SDData
+
+    data is the raw message buffer, offset is where the payload
+    starts. Only the fields DataOutputConfigMask says are present
+    are in the message. sensor_decoder() gives a struct for that
+    mask which unpacks all of them in place in one call, so
+    nothing is copied out of the buffer. The last decoder is kept
+    and only looked up again when the mask changes. timestamp is
+    the host time the message was read, defaulting to now.
+    '''
+    if timestamp == None:
+      timestamp = time.time()
+    if offset != SW_HEADER_SIZE:
+      # Decoders read whole messages, line the payload up to match
+      data = bytearray(SW_HEADER_SIZE) + bytearray(data[offset:])
+    self._decode_sensor(self._unpack_sensor(data), timestamp)
+
+  def _unpack_sensor(self, data):
+    '''
+    Unpack a whole sensor data message, switching decoder if its
+    DataOutputConfigMask is not the one the last message had
     '''
+    decoder = self._decoder
+    try:
+      values = decoder[1].unpack_from(data, 0)
+    except struct.error:
+      # Too short for the last layout, the mask must have changed
+      values = (None,) * 5
+    if values[4] != decoder[0]:
+      decoder = self._decoder = sensor_decoder(_PAYLOAD_HEADER.unpack_from(data, SW_HEADER_SIZE)[0])
+      values = decoder[1].unpack_from(data, 0)
+    return values
+
+  def _decode_sensor(self, values, timestamp):
+    '''
+    Act on one sensor data message as unpacked by self._decoder
+    '''
+    d_timestamp = values[5]
+    d_sysinfo = values[6]
+    mask, unpacker, i_gesture, i_touch, i_airwheel, i_xyz = self._decoder
+
+    x = y = z = 0.0
+    if i_xyz >= 0:
+      x = values[i_xyz] / 65536.0
+      y = values[i_xyz + 1] / 65536.0
+      z = values[i_xyz + 2] / 65536.0
+
+    d_airwheel = 0
+    if i_airwheel >= 0:
+      d_airwheel = values[i_airwheel]
+
+    stats = self._stats
+    if timestamp - stats.last_time <= 1.0:
+      stats.sensor_frames += 1
+      stats.device_ticks += (d_timestamp - stats.last_counter) & 0xff
+      stats.last_counter = d_timestamp
+      stats.last_time = timestamp
+    else:
+      stats.sensor(d_timestamp, timestamp)
+
+    health = self._health
+    if d_sysinfo & _SYSINFO_HEALTH != SW_SYSINFO_DSP or health.abnormal:
+      health.sysinfo(d_sysinfo & _SYSINFO_HEALTH, timestamp)
+
+    if self._ring != None:
+      self._ring.push(timestamp, d_timestamp, d_sysinfo, x, y, z, d_airwheel)
+
+    if i_xyz >= 0 and d_sysinfo & 0b0000001:
+      # We have xyz info, and it's valid
+      if self._filter != None:
+        x, y, z = self._filter.update(x, y, z, timestamp)
+      latest = self._latest
+      latest.sample = (x, y, z, timestamp, latest.sample[4] + 1)
+      self._predictor.append((timestamp, x, y, z))
+      if self._dispatch == None and not self._streams:
+        # Inline delivery, as _deliver() would do it for 'move'
+        route = self.handlers.routes.get('move')
+        if route:
+          self._call(route, (x, y, z), timestamp)
+      else:
+        self._emit('move', (x, y, z), timestamp)
+      #print( x, y, z )
+
+    d_gesture = 0
+    if i_gesture >= 0:
+      d_gesture = values[i_gesture]
+
+    if 0 < d_gesture <= len(GESTURES):
+      # We have a gesture!
+      d_gesture_edge = values[i_gesture + 2]
+      is_edge = (d_gesture_edge & 0b00000001) > 0
+      kind, args = _GESTURE_EVENTS[d_gesture - 1]
+
+      self._emit(kind, args + (is_edge, timestamp), timestamp)
+
+    d_action = 0
+    if i_touch >= 0:
+      d_action = values[i_touch] & _TOUCH_MASK
+
+    if d_action:
+      # We have a touch, the highest action bit set wins
+      d_touchcount = values[i_touch + 1] * 5 # Time to touch in ms
+
+      action = TOUCH_ACTIONS[d_action.bit_length() - 1]
+      #print(action, d_touchcount)
+      self._emit(action[0], action[1:], timestamp)
+
+    if i_airwheel >= 0 and d_sysinfo & 0b00000010:
+      # Airwheel
+      delta = self._airwheel.update(d_airwheel, d_timestamp, timestamp)
+      '''
+      Delta is in degrees, positive numbers equal clockwise delta,
+      negative are counter-clockwise
+      '''
+      if delta:
+        self._emit('airwheel', (delta,), timestamp)
+    elif self._airwheel.active:
+      self._airwheel.stop(timestamp)
+
+  def handle_status_info(self, data, offset=SW_HEADER_SIZE, timestamp=None):
+    '''
+    | HEADER | PAYLOAD
+    |        | MsgID 1 | MaxCmdSize 1 | ErrorCode 2 | Reserved 8 |
+
+    Sent in answer to every command, MsgID names the command
+    and ErrorCode is 0 if it succeeded.
+    '''
+    d_msg_id, d_max_cmd_size, d_error = _SYSTEM_STATUS.unpack_from(data, offset)
+    self._health.set_status({
+      'msg_id':       d_msg_id,
+      'max_cmd_size': d_max_cmd_size,
+      'error':        d_error,
+      'timestamp':    timestamp
+    })
+
+  def handle_firmware_info(self, data, offset=SW_HEADER_SIZE, timestamp=None):
+    '''
+    data holds only the bytes that were read, the version string
+    runs to its end or to the first NUL
+    '''
+    (d_fw_valid, d_hw_rev, d_param_st,
+     d_loader_major, d_loader_minor, d_loader_rev,
+     d_fw_st) = _FIRMWARE_PAYLOAD.unpack_from(data, offset)
+    d_loader_version = ( d_loader_major, d_loader_minor, d_loader_rev )
+    d_fw_version = bytes(data[offset + _FIRMWARE_PAYLOAD.size:]).split(b'\0')[0]
+
+    self._health.set_firmware({
+      'valid':          d_fw_valid == 0xaa,
+      'hw_rev':         d_hw_rev,
+      'param_start':    d_param_st,
+      'loader_version': d_loader_version,
+      'fw_start':       d_fw_st,
+      'version':        d_fw_version.decode('ascii', 'replace'),
+      'timestamp':      timestamp
+    })
+
+  def handle_message(self, data, timestamp=None):
+    '''
+    Decode one raw message as read from the MGC3130
+
+    The bytes are copied into the device's preallocated receive
+    buffer and every handler unpacks its fields straight from it.
+
     MSG | HEADER                  | PAYLOAD
         | size | flags | seq | ID | Depends on ID
 
@@ -281,129 +2214,1021 @@ def _do_poll():
     flags: reserved
     seq: Increments with each message sent
     ID: message ID
+
+    timestamp is the host time the message was read, defaulting
+    to now.
     '''
-    d_size  = data.pop(0)
-    d_flags = data.pop(0)
-    d_seq   = data.pop(0)
-    d_ident = data.pop(0)
+    if timestamp == None:
+      timestamp = time.time()
+
+    size = len(data)
+    rx_buf = self._rx_buf
+    rx_buf[0:size] = data
 
-    if   d_ident == 0x91:
-      handle_sensor_data(data)
-    elif d_ident == 0x15:
-      handle_status_info(data)
+    '''
+    Most messages are sensor data laid out like the last one, so
+    the whole message is unpacked with that decoder straight away
+    and only the header is used if it turns out to be otherwise
+    '''
+    values = self._decoder[1].unpack_from(rx_buf, 0)
+    d_size, d_flags, d_seq, d_ident = values[0:4]
+    stats = self._stats
+    if d_seq == stats.next_seq:
+      stats.next_seq = (d_seq + 1) & 0xff
+      stats.frames_received += 1
+    else:
+      stats.message(d_seq)
+
+    planner = self._planner
+    if d_ident == 0x91:
+      if d_size != planner.size:
+        planner.received(d_ident, d_size)
+      if d_size > size:
+        # Cut short by the read, the rest of the buffer is stale
+        stats.truncated += 1
+      else:
+        if values[4] != self._decoder[0]:
+          values = self._unpack_sensor(rx_buf)
+        self._decode_sensor(values, timestamp)
+      return
+
+    if planner.replies > 0:
+      planner.received(d_ident, d_size)
+
+    if d_ident == 0x15:
+      self.handle_status_info(rx_buf, SW_HEADER_SIZE, timestamp)
     elif d_ident == 0x83:
-      handle_firmware_info(data)
+      self.handle_firmware_info(rx_buf[:min(d_size, size)], SW_HEADER_SIZE, timestamp)
     else:
       pass
 
-    GPIO.setup(SW_XFER_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+  # Dispatch
 
-def start_poll():
-  global worker
-  if worker == None:
-    worker = AsyncWorker(_do_poll)
-  worker.start()
+  def _emit(self, kind, args, timestamp):
+    dispatch = self._dispatch
+    if dispatch == None and not self._streams:
+      self._deliver(kind, args, timestamp)
+      return
 
-def stop_poll():
-  global worker
-  worker.stop()
+    event = Event(kind, args, timestamp, self)
+    if dispatch != None:
+      dispatch.put(event)
+    else:
+      self._deliver(kind, args, timestamp)
+    for stream in self._streams:
+      stream.queue.put(event)
+
+  def _deliver(self, kind, args, timestamp):
+    '''
+    Call the registered handlers for one event
+    '''
+    if kind in _TOUCH_KINDS:
+      route = self.handlers.routes.get((kind, args[0]))
+    else:
+      route = self.handlers.routes.get(kind)
+    if route:
+      self._call(route, args, timestamp)
+
+  def _call(self, route, args, timestamp):
+    '''
+    Call every (handler, arity) in route with args
+    '''
+    for handler, arity in route:
+      try:
+        if arity == None:
+          handler(*args)
+        else:
+          handler(*args[:arity])
+      except Exception:
+        # A broken handler must not stop the poller or the others
+        self._health.handler_errors += 1
+        traceback.print_exc()
+
+    stats = self._stats
+    stats.latency_skip -= 1
+    if stats.latency_skip <= 0:
+      stats.latency(time.time() - timestamp)
+
+  # Polling, called on the Scheduler's thread
+
+  def _watch_transfer(self):
+    '''
+    Have every falling edge of TS set self._edge
+
+    Edge detection stays armed from open() to close(), so an edge
+    is caught whenever it comes, not only while the poller waits.
+    '''
+    if not self.use_interrupts or self._watching:
+      return
+    try:
+      self.GPIO.add_event_detect(self.xfer_pin, self.GPIO.FALLING, callback=self._on_edge)
+      self._watching = True
+    except (AttributeError, TypeError, RuntimeError):
+      '''
+      GPIO module without edge callbacks, or edge detection
+      already claimed on this pin, fall back to sleep polling
+      '''
+      self.use_interrupts = False
+
+  def _unwatch_transfer(self):
+    if self._watching:
+      self._watching = False
+      self.GPIO.remove_event_detect(self.xfer_pin)
+
+  def _on_edge(self, pin):
+    self._edge.set()
+
+  def _wait_for_transfer(self):
+    '''
+    Wait for the MGC3130 to pull the transfer line low
+
+    Waits on the edge callback rather than spinning on
+    GPIO.input, so the polling thread sleeps until data is ready.
+    The event is cleared before the line is checked, so an edge
+    that comes between the check and the wait still ends it. The
+    wait is bounded by SW_XFER_TIMEOUT so stop_poll() is honoured.
+
+    Returns True if the line is low and a message can be read.
+    '''
+    GPIO = self.GPIO
+
+    self._edge.clear()
+    if not GPIO.input(self.xfer_pin):
+      return True
+
+    if self._watching:
+      self._edge.wait(SW_XFER_TIMEOUT / 1000.0)
+    else:
+      time.sleep(SW_POLL_INTERVAL)
+
+    return not GPIO.input(self.xfer_pin)
+
+  def _write_message(self, msg):
+    self.i2c.write_i2c_block_data(self.addr, msg[0], list(msg[1:]))
+    self._planner.expect_reply()
+
+  def _read(self):
+    '''
+    Read and decode one message, TS must already be low
+    '''
+    GPIO = self.GPIO
+
+    '''
+    Assert transfer line low to ensure
+    MGC3130 doesn't update data buffers
+    '''
+    GPIO.setup(self.xfer_pin, GPIO.OUT, initial=GPIO.LOW)
+    try:
+      size = self._planner.next_size()
+      data = self.i2c.read_i2c_block_data(self.addr, 0x00, size)
+    finally:
+      # Release the line as soon as the message is in, before decoding
+      GPIO.setup(self.xfer_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+    timestamp = time.time()
+    self._stats.transfer(size, self._planner.transfer_time(size))
+    if self._capture != None:
+      self._capture.write(timestamp, data)
+
+    self._last_read = timestamp
+
+    self.handle_message(data, timestamp)
+
+  def _poll(self):
+    '''
+    One pass for a device polled on its own, sleeps until TS drops
+    '''
+    if not self._ready.is_set():
+      # Reset still in progress, see open(wait=False)
+      self._ready.wait(SW_XFER_TIMEOUT / 1000.0)
+      return
+
+    while self._commands:
+      # Commands queued by other threads go out between reads
+      self._write_message(self._commands.popleft())
+
+    if self._wait_for_transfer():
+      self._read()
+
+  def _service(self):
+    '''
+    One pass for a device polled alongside others, never sleeps
+
+    Returns True if a message was read.
+    '''
+    if not self._ready.is_set():
+      return False
+
+    while self._commands:
+      self._write_message(self._commands.popleft())
+
+    if self.GPIO.input(self.xfer_pin):
+      return False
+    self._read()
+    return True
+
+  def start_poll(self):
+    self.scheduler.add(self)
+
+  def stop_poll(self):
+    self.scheduler.remove(self)
+
+  # Lifecycle and configuration
+
+  def _select_backend(self):
+    if SW_BACKEND == 'sim':
+      sim = SimulatedMGC3130(rate=SW_SIM_RATE, xfer_pin=self.xfer_pin, reset_pin=self.reset_pin)
+      self.i2c, self.GPIO = sim, sim
+    elif SW_BACKEND == 'replay':
+      sim = ReplayMGC3130(SW_REPLAY, xfer_pin=self.xfer_pin, reset_pin=self.reset_pin)
+      self.i2c, self.GPIO = sim, sim
+    else:
+      bus, gpio = hardware_backend(self.bus_id)
+      if self.i2c == None:
+        self.i2c = bus
+      if self.GPIO == None:
+        self.GPIO = gpio
+
+  def _configure(self):
+    self.reset()
+    self._commands.clear()
+    mask = self._output_mask = self._wanted_mask()
+    for msg in _output_mask_messages(mask):
+      self._write_message(msg)
+    runtime = list(self._runtime.items())
+    for (param, arg1), arg0 in runtime:
+      # Parameters set before the reset, or during it
+      self._write_message(_runtime_message(param, arg0, arg1))
+    self._planner.set_mask(mask)
+    self._last_read = time.time()
+    self._ready.set()
+
+    '''
+    _send() dropped anything asked for while the above was being
+    written, send what has changed since
+    '''
+    self._output_mask = mask
+    self._update_mask()
+    for (param, arg1), arg0 in list(self._runtime.items()):
+      if ((param, arg1), arg0) not in runtime:
+        self._send(_runtime_message(param, arg0, arg1))
+
+  def _open_configure(self):
+    try:
+      self._configure()
+    except Exception as e:
+      self._fault('bus' if isinstance(e, (IOError, OSError)) else 'error', e)
+
+  # Supervision, see Watchdog
+
+  def _check(self, now):
+    '''
+    Called by the Scheduler every SW_WATCHDOG_INTERVAL
+    '''
+    self.handlers.collect()
+    if not self._ready.is_set():
+      return
+    watchdog = self.watchdog
+    # With approach detection on the chip idles in self wake-up mode and goes quiet
+    approach = self._runtime.get((SW_PARAM_APPROACH_DETECTION, 0x01), 0)
+    if now - self._last_read > watchdog.silence and not approach:
+      self._fault('silence', 'no message for %.1fs' % (now - self._last_read))
+    elif not self._health.dsp_running and now - self._health.dsp_stopped_at > watchdog.dsp_timeout:
+      self._fault('dsp', 'DSPRunning clear for %.1fs' % (now - self._health.dsp_stopped_at))
+    elif watchdog.tries and watchdog.state == 'ok' and self._last_read - watchdog.recovered_at > watchdog.dsp_timeout:
+      # Healthy for a while since the last recovery, the next fault starts the backoff over
+      watchdog.tries = 0
+
+  def _fault(self, kind, description):
+    '''
+    Record a fault, stop reading the device and start recovery
+    '''
+    self.watchdog.fault(kind, str(description))
+    self._ready.clear()
+    if self._recovery != None or self._opener == None:
+      return
+    if self.auto_recover:
+      self._recover()
+    else:
+      self.watchdog.state = 'failed'
+
+  def recover(self):
+    '''
+    Reset and reconfigure the device on a background thread
+
+    The watchdog does this itself when auto_recover is set, call
+    it to retry a device whose watchdog state is 'failed'. The
+    backoff starts over, with the full number of attempts.
+    '''
+    if self._recovery != None:
+      return
+    self.watchdog.tries = 0
+    self._recover()
+
+  def _recover(self):
+    if self._recovery != None:
+      return
+    self._ready.clear()
+    self.watchdog.state = 'recovering'
+    self._recovery = AsyncWorker(self._do_recover)
+    self._recovery.start()
+
+  def _do_recover(self):
+    worker = self._recovery
+    delay = self.watchdog.backoff()
+    if worker == None or delay == None:
+      self.watchdog.state = 'failed'
+      self._recovery = None
+      return False
+
+    worker.stop_event.wait(delay)
+    if worker.stop_event.is_set():
+      return False
+
+    self.watchdog.tries += 1
+    try:
+      self.GPIO.setup(self.xfer_pin, self.GPIO.IN, pull_up_down=self.GPIO.PUD_UP)
+      self._configure()
+    except Exception as e:
+      self.watchdog.fault('bus' if isinstance(e, (IOError, OSError)) else 'error', str(e))
+      return True
+
+    self.watchdog.recoveries += 1
+    self.watchdog.recovered_at = time.time()
+    self.watchdog.state = 'ok'
+    self._health.dsp_running = True
+    self._recovery = None
+    return False
+
+  def _send(self, msg):
+    '''
+    Write a message to the chip, via the poller if it is running
+
+    Before the device is ready nothing is sent, _configure() writes
+    the current settings once the reset completes.
+    '''
+    if not self._ready.is_set():
+      return
+    if self.polling:
+      self._commands.append(msg)
+    else:
+      self._write_message(msg)
+
+  def set_runtime_parameter(self, param, arg0, arg1=0xFFFFFFFF):
+    '''
+    Set one of the MGC3130's runtime parameters, see SW_PARAM_*
+
+    The command is sent by the poller between reads if it is
+    running. Until the device is open and its reset has finished
+    the parameter is only recorded, and sent once it is ready.
+    '''
+    self._runtime[(param, arg1)] = arg0
+    self._send(_runtime_message(param, arg0, arg1))
+
+  def set_approach_detection(self, enabled):
+    self.set_runtime_parameter(SW_PARAM_APPROACH_DETECTION, 0x01 if enabled else 0x00, 0x01)
+
+  def set_touch_detection(self, enabled):
+    self.set_runtime_parameter(SW_PARAM_TOUCH_DETECTION, 0x08 if enabled else 0x00, 0x08)
+
+  def set_airwheel_detection(self, enabled):
+    self.set_runtime_parameter(SW_PARAM_AIRWHEEL, 0x20 if enabled else 0x00, 0x20)
+
+  def _wanted_mask(self):
+    '''
+    Work out the outputs the registered handlers and consumers need
+    '''
+    if not self.auto_mask:
+      return SW_OUTPUT_MASK
+
+    mask = self._required
+    for kind in self.handlers.kinds():
+      mask |= _EVENT_OUTPUTS.get(kind, 0)
+    if self._streams:
+      mask |= SW_OUTPUT_MASK
+    return mask
+
+  def _update_mask(self):
+    '''
+    Reprogram the chip if the outputs needed have changed
+    '''
+    mask = self._wanted_mask()
+    if mask != self._output_mask:
+      self._output_mask = mask
+      for msg in _output_mask_messages(mask):
+        self._send(msg)
+      self._planner.set_mask(mask)
+
+  def require(self, mask):
+    '''
+    Keep outputs enabled for consumers that poll rather than register
+
+    mask is any combination of SW_DATA_*. get_latest(), get_ring()
+    and events() ask for what they need themselves.
+    '''
+    self._required |= mask
+    self._update_mask()
+
+  def release(self, mask):
+    '''
+    Undo require() for the outputs in mask
+    '''
+    self._required &= ~mask
+    self._update_mask()
+
+  def get_output_mask(self):
+    '''
+    Return the DataOutputConfigMask the chip has been asked for
+    '''
+    return self._output_mask
+
+  def open(self, wait=True):
+    '''
+    Open the bus, then reset and configure the MGC3130
+
+    Nothing touches the hardware until this is called, either
+    directly, through start() or by registering a handler.
+
+    The reset takes over half a second, with wait=False it runs
+    on a background thread so it can overlap with display setup,
+    or with resetting other devices. The poller holds off until
+    it has finished.
+    '''
+    if self._opener == None:
+      if self.i2c == None or self.GPIO == None:
+        self._select_backend()
+
+      GPIO = self.GPIO
+      GPIO.setmode(GPIO.BCM)
+      GPIO.setup(self.reset_pin, GPIO.OUT, initial=GPIO.HIGH)
+      GPIO.setup(self.xfer_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+      self._watch_transfer()
+
+      self._opener = threading.Thread(target=self._open_configure)
+      self._opener.daemon = True
+      self._opener.start()
+      _opened.append(self)
+
+    if wait:
+      self._opener.join()
+
+  def start(self):
+    '''
+    Open the device without waiting for the reset, and start polling
+    '''
+    self.open(wait=False)
+    self.start_poll()
+
+  def close(self):
+    '''
+    Stop polling and release this device's GPIO lines
+    '''
+    self.stop_poll()
+    self.stop_capture()
+    recovery, self._recovery = self._recovery, None
+    if recovery != None:
+      recovery.stop()
+    if self._opener != None:
+      self._opener.join()
+      self._opener = None
+      self._runtime.clear()
+      self.watchdog.state = 'ok'
+      self._ready.clear()
+      self._unwatch_transfer()
+      self.GPIO.cleanup((self.reset_pin, self.xfer_pin))
+      if self in _opened:
+        _opened.remove(self)
+
+  def _autostart(self):
+    if self.autostart and not self.polling:
+      self.start()
+
+  def use_backend(self, bus, gpio):
+    '''
+    Swap the I2C bus and GPIO lines the device talks to
+
+    bus must provide read_i2c_block_data/write_i2c_block_data
+    like python-smbus, gpio must look like the RPi.GPIO module.
+    If the device was open it is closed, then the new one is
+    opened, reset and configured and polling resumes if it was
+    running before.
+    '''
+    running = self.polling
+    was_open = self._opener != None
+    self.close()
+
+    self.i2c, self.GPIO = bus, gpio
+    self.use_interrupts = True
+
+    if was_open:
+      self.open()
+    if running:
+      self.start_poll()
+
+  # Consumers
+
+  def get_latest(self):
+    '''
+    Return the most recent (x, y, z, timestamp, seq) position
+
+    Cheap enough to call once per rendered frame instead of
+    registering a move() handler. seq only changes when a new
+    position arrives, so comparing it with the previous call
+    tells whether the hand has been seen since.
+    '''
+    if not self._required & SW_DATA_XYZ:
+      self.require(SW_DATA_XYZ)
+    return self._latest.sample
+
+  def get_ring(self, capacity=SW_RING_SIZE, outputs=SW_DATA_XYZ):
+    '''
+    Return the SampleRing that records every sensor frame
+
+    The ring is created on first use, frames are only recorded
+    from then on. outputs is the SW_DATA_* streams the caller
+    reads from it, eg. SW_DATA_XYZ | SW_DATA_AIRWHEEL to fill in
+    airwheel too, fields of streams nobody asked for stay 0.
+    Requires numpy.
+    '''
+    if self._ring == None:
+      self._ring = SampleRing(capacity)
+    if outputs & ~self._required:
+      self.require(outputs)
+    return self._ring
+
+  def drain(self, outputs=SW_DATA_XYZ):
+    '''
+    Return every frame recorded since the previous drain()
+
+    Samples come back as one NumPy structured array, see
+    SAMPLE_DTYPE. The first call starts recording and returns an
+    empty array. outputs is as for get_ring(). Consumers that need
+    their own position in the stream should use get_ring().reader()
+    instead.
+    '''
+    if self._ring_reader == None:
+      self._ring_reader = self.get_ring(outputs=outputs).reader()
+    elif outputs & ~self._required:
+      self.require(outputs)
+    return self._ring_reader.drain()
+
+  def get_stats(self):
+    '''
+    Return frame loss and latency counters as a dict
+
+    See Stats for what each entry means. A rising frames_dropped
+    means the poller is not keeping up with the sensor.
+    '''
+    return self._stats.get()
+
+  def reset_stats(self):
+    self._stats.reset()
+
+  def events(self, maxsize=64, overflow='drop-oldest', coalesce=('move',), loop=None):
+    '''
+    Return an async iterator of Events for asyncio applications
+
+      async for event in skywriter.events():
+        if event.kind == 'move':
+          x, y, z = event.args
+
+    Frames are still read on the polling thread, events reach the
+    loop through a bounded EventQueue, see there for maxsize,
+    overflow and coalesce. Call close() on the stream to stop.
+    Starts polling if it is not already running.
+    '''
+    if loop == None:
+      import asyncio
+      loop = asyncio.get_event_loop()
+
+    stream = EventStream(self, loop, maxsize, overflow, coalesce)
+    self._streams = self._streams + [stream]
+    self._update_mask()
+    self._autostart()
+    return stream
+
+  def _close_stream(self, stream):
+    self._streams = [other for other in self._streams if other is not stream]
+    self._update_mask()
+
+  def start_capture(self, path):
+    '''
+    Record every raw message read to a capture file
+
+    Messages are appended to path along with the host time they
+    were read, see CaptureFile and ReplayMGC3130 to play them back.
+    '''
+    self.stop_capture()
+    self._capture = CaptureWriter(path)
+
+  def stop_capture(self):
+    capture, self._capture = self._capture, None
+    if capture != None:
+      capture.close()
+
+  def set_filter(self, motion_filter):
+    '''
+    Smooth positions before they are published and dispatched
+
+    motion_filter is an EMAFilter, OneEuroFilter, KalmanFilter or
+    any Filter, or None to pass raw positions through. It applies
+    to get_latest(), move() handlers and events(), the ring keeps
+    raw samples, use Filter.apply() on drained batches.
+    '''
+    if motion_filter != None:
+      motion_filter.reset()
+    self._filter = motion_filter
+
+  def get_filter(self):
+    return self._filter
+
+  def predict(self, t_future):
+    '''
+    Return the (x, y, z) position expected at host time t_future
+
+    Pass the time the frame being rendered will reach the screen,
+    eg. time.time() plus the render loop's latency, to draw where
+    the hand will be rather than where it was.
+    '''
+    if not self._required & SW_DATA_XYZ:
+      self.require(SW_DATA_XYZ)
+    return self._predictor.predict(t_future)
+
+  def request_message(self, msg_id, param=0):
+    '''
+    Ask the chip to send message msg_id, eg. SW_FW_VERSION
+
+    The answer is read and decoded by the poller like any other
+    message.
+    '''
+    if not self._ready.is_set():
+      raise RuntimeError("skywriter is not open")
+    self._send(bytearray(_REQUEST_MSG.pack(_REQUEST_MSG.size, 0, 0, SW_REQUEST_MSG, msg_id, param)))
+
+  def _request_cached(self, msg_id, cached, refresh, timeout):
+    '''
+    Ask for msg_id and wait up to timeout seconds for the answer
+
+    A device that is still being reset, by start() or by the
+    Watchdog, is waited for within the same timeout. If it never
+    becomes ready the caller gets whatever is cached.
+    '''
+    if cached != None and not refresh:
+      return
+    deadline = time.time() + timeout
+    if not self._ready.wait(timeout):
+      return
+    reply = self._health.replies[msg_id]
+    reply.clear()
+    try:
+      self.request_message(msg_id)
+    except RuntimeError:
+      # Closed or reset again since it was ready
+      return
+    reply.wait(max(0.0, deadline - time.time()))
+
+  def get_firmware(self, refresh=False, timeout=SW_HEALTH_TIMEOUT):
+    '''
+    Return the firmware info as a dict, see Health
+
+    Asked for once and then cached, refresh asks again. Needs the
+    poller running to read the answer, returns the cached info, or
+    None, if none arrives within timeout seconds, which includes
+    time spent waiting for a device that is still being reset.
+    '''
+    self._request_cached(SW_FW_VERSION, self._health.firmware, refresh, timeout)
+    return self._health.firmware
+
+  def get_status(self, refresh=True, timeout=SW_HEALTH_TIMEOUT):
+    '''
+    Return the latest System_Status as a dict, see Health
+
+    The chip also sends one after every command, with refresh
+    False that cached answer is returned without asking. Like
+    get_firmware() it never raises, the cached answer or None is
+    returned if nothing arrives within timeout seconds.
+    '''
+    self._request_cached(SW_SYSTEM_STATUS, self._health.status, refresh, timeout)
+    return self._health.status
+
+  def get_health(self):
+    '''
+    Return cached firmware, status and SystemInfo counters as a dict
+
+    Never touches the bus, so it is cheap enough to scrape from
+    a monitoring loop, see Health for what each entry means. The
+    'watchdog' entry holds the Watchdog's state and fault counts.
+    '''
+    health = self._health.get()
+    health['watchdog'] = self.watchdog.get()
+    return health
+
+  def get_airwheel(self):
+    '''
+    Return the airwheel's (rotation, velocity, timestamp)
+
+    rotation is in degrees clockwise, unwrapped, velocity is in
+    degrees per second, see AirWheel. Cheap enough to call once
+    per rendered frame instead of registering airwheel().
+    '''
+    if not self._required & SW_DATA_AIRWHEEL:
+      self.require(SW_DATA_AIRWHEEL)
+    return self._airwheel.state
+
+  @property
+  def rotation(self):
+    return self.get_airwheel()[0]
+
+  @property
+  def angular_velocity(self):
+    return self.get_airwheel()[1]
+
+  # Handler registration
+
+  def subscribe(self, kind, handler, position=None, weak=False, details=False):
+    '''
+    Call handler for every event of kind, see HandlerRegistry
+
+    position narrows touch, tap and doubletap handlers to one pad.
+    With weak set the handler is held by weak reference. With
+    details set gesture handlers also get the edge flag and the
+    host timestamp. Starts polling if autostart is set.
+    '''
+    self.handlers.subscribe(kind, handler, position, weak, details)
+    self._autostart()
+
+  def unsubscribe(self, handler, kind=None, position=None):
+    '''
+    Remove handler, from kind and position if given
+
+    Returns the number of subscriptions removed.
+    '''
+    return self.handlers.unsubscribe(handler, kind, position)
+
+  def _decorator(self, kind, position=None, weak=False, details=False):
+    def register(handler):
+      self.subscribe(kind, handler, position, weak, details)
+      return handler
+    return register
+
+  def flick(self, *args, **kwargs):
+    '''
+    Bind flick gesture
+
+    Called with (start, end), start and end are 'north', 'south',
+    'east' or 'west'. With details=True it is called with (start,
+    end, edge, timestamp) instead, edge is True for a flick that
+    started at the edge of the pad and timestamp is the host time
+    the gesture was read.
+    '''
+    return self._decorator('flick', weak=get_arg(kwargs, 'weak', False),
+                           details=get_arg(kwargs, 'details', False))
+
+  def circle(self, *args, **kwargs):
+    '''
+    Bind circle gesture
+
+    Called with (direction), direction is 'clockwise' or
+    'counter-clockwise'. With details=True it is called with
+    (direction, edge, timestamp) instead.
+    '''
+    return self._decorator('circle', weak=get_arg(kwargs, 'weak', False),
+                           details=get_arg(kwargs, 'details', False))
+
+  def touch(self, *args, **kwargs):
+    '''
+    Bind touch event
+    '''
+    return self._decorator('touch', get_arg(kwargs, 'position', 'all'), get_arg(kwargs, 'weak', False))
+
+  def tap(self, *args, **kwargs):
+    '''
+    Bind tap event
+    '''
+    return self._decorator('tap', get_arg(kwargs, 'position', 'all'), get_arg(kwargs, 'weak', False))
+
+  def double_tap(self, *args, **kwargs):
+    '''
+    Bind double tap event
+    '''
+    return self._decorator('doubletap', get_arg(kwargs, 'position', 'all'), get_arg(kwargs, 'weak', False))
+
+  def garbage(self, weak=False, details=False):
+    '''
+    Bind unrecognised gesture, called with no arguments, or with
+    (edge, timestamp) if details is set
+    '''
+    return self._decorator('garbage', weak=weak, details=details)
+
+  def move(self, weak=False):
+    return self._decorator('move', weak=weak)
+
+  def airwheel(self, weak=False):
+    '''
+    Bind airwheel, called with the change in degrees, clockwise positive
+    '''
+    return self._decorator('airwheel', weak=weak)
+
+def _runtime_message(param, arg0, arg1):
+  return bytearray(_SET_RUNTIME.pack(_SET_RUNTIME.size, 0, 0, SW_SET_RUNTIME, param, arg0, arg1))
+
+def _output_mask_messages(mask):
+  '''
+  Enable and lock exactly the outputs in mask
+
+  Locking makes the chip send those fields even when they are
+  not valid, which keeps every sensor message the same size.
+  '''
+  return (
+    _runtime_message(SW_PARAM_DATA_OUTPUT_ENABLE, mask, SW_OUTPUT_BITS),
+    _runtime_message(SW_PARAM_DATA_OUTPUT_LOCK, mask, SW_OUTPUT_BITS)
+  )
 
 def get_arg(args, arg, default = None):
   if arg in args.keys():
     return args[arg]
   return default
 
-def flick(*args, **kwargs):
-  def register(handler):
-    global _on_flick
-    _on_flick = handler
-  return register
+_opened = []
+_default = None
 
+def default_device():
+  '''
+  Return the Skywriter the module level functions act on
 
+  It is the board on bus i2c_bus_id() at SW_ADDR, created on
+  first use, so autostart, threaded_dispatch, auto_mask and
+  use_interrupts can still be set on the module beforehand.
+  '''
+  global _default
+  if _default == None:
+    _default = Skywriter()
+  return _default
 
-def touch(*args, **kwargs):
+'''
+Module attributes from before Skywriter, each read from
+default_device() when looked up
+
+rotation: airwheel rotation in full turns, clockwise
+worker: the thread polling it, None until started
+i2c, GPIO: the bus and GPIO module it uses, None until opened
+'''
+_LEGACY_ATTRIBUTES = {
+  'rotation': lambda device: device.rotation / 360.0,
+  'worker':   lambda device: device.scheduler.worker,
+  'i2c':      lambda device: device.i2c,
+  'GPIO':     lambda device: device.GPIO
+}
+
+def __getattr__(name):
   '''
-  Bind touch event
+  Python 3.7 and later call this for names the module lacks,
+  older versions never do, use default_device() there instead
   '''
-  global _on_touch
+  if name in _LEGACY_ATTRIBUTES:
+    return _LEGACY_ATTRIBUTES[name](default_device())
+  raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
-  t_position = get_arg(kwargs, 'position', 'all')
+'''
+Module level API, each of these calls the method of the same
+name on default_device(), see Skywriter
+'''
+def reset():
+  default_device().reset()
 
-  if not 'touch' in _on_touch.keys():
-    _on_touch['touch'] = {}
+def handle_sensor_data(data, offset=SW_HEADER_SIZE, timestamp=None):
+  default_device().handle_sensor_data(data, offset, timestamp)
 
-  def register(handler):
-    global _on_touch
-    _on_touch['touch'][t_position] = handler
+def handle_status_info(data, offset=SW_HEADER_SIZE, timestamp=None):
+  default_device().handle_status_info(data, offset, timestamp)
 
-  return register
+def handle_firmware_info(data, offset=SW_HEADER_SIZE, timestamp=None):
+  default_device().handle_firmware_info(data, offset, timestamp)
 
+def handle_message(data, timestamp=None):
+  default_device().handle_message(data, timestamp)
 
+def start_poll():
+  default_device().start_poll()
 
-def tap(*args, **kwargs):
-  '''
-  Bind tap event
-  '''
-  global _on_touch
+def stop_poll():
+  default_device().stop_poll()
 
-  t_position = get_arg(kwargs, 'position', 'all')
+def set_runtime_parameter(param, arg0, arg1=0xFFFFFFFF):
+  default_device().set_runtime_parameter(param, arg0, arg1)
 
-  if not 'tap' in _on_touch.keys():
-    _on_touch['tap'] = {}
+def set_approach_detection(enabled):
+  default_device().set_approach_detection(enabled)
 
-  def register(handler):
-    global _on_touch
-    _on_touch['tap'][t_position] = handler
+def set_touch_detection(enabled):
+  default_device().set_touch_detection(enabled)
 
-  return register
+def set_airwheel_detection(enabled):
+  default_device().set_airwheel_detection(enabled)
 
+def require(mask):
+  default_device().require(mask)
 
+def release(mask):
+  default_device().release(mask)
 
-def double_tap(*args, **kwargs):
-  '''
-  Bind double tap event
-  '''
-  global _on_touch
+def get_output_mask():
+  return default_device().get_output_mask()
+
+def open(wait=True):
+  default_device().open(wait)
+
+def start():
+  default_device().start()
+
+def close():
+  default_device().close()
+
+def get_latest():
+  return default_device().get_latest()
+
+def get_ring(capacity=SW_RING_SIZE, outputs=SW_DATA_XYZ):
+  return default_device().get_ring(capacity, outputs)
+
+def drain(outputs=SW_DATA_XYZ):
+  return default_device().drain(outputs)
+
+def get_stats():
+  return default_device().get_stats()
+
+def reset_stats():
+  default_device().reset_stats()
+
+def events(maxsize=64, overflow='drop-oldest', coalesce=('move',), loop=None):
+  return default_device().events(maxsize, overflow, coalesce, loop)
+
+def start_capture(path):
+  default_device().start_capture(path)
+
+def stop_capture():
+  default_device().stop_capture()
+
+def set_filter(motion_filter):
+  default_device().set_filter(motion_filter)
 
-  t_position = get_arg(kwargs, 'position', 'all')
+def get_filter():
+  return default_device().get_filter()
 
-  if not 'doubletap' in _on_touch.keys():
-    _on_touch['doubletap'] = {}
+def predict(t_future):
+  return default_device().predict(t_future)
 
-  def register(handler):
-    global _on_touch
-    _on_touch['doubletap'][t_position] = handler
+def request_message(msg_id, param=0):
+  default_device().request_message(msg_id, param)
 
-  return register
+def get_firmware(refresh=False, timeout=SW_HEALTH_TIMEOUT):
+  return default_device().get_firmware(refresh, timeout)
 
+def get_status(refresh=True, timeout=SW_HEALTH_TIMEOUT):
+  return default_device().get_status(refresh, timeout)
 
-def garbage():
-  def register(handler):
-    global _on_garbage
-    _on_garbage = handler
-  return register
+def get_health():
+  return default_device().get_health()
 
+def recover():
+  default_device().recover()
 
+def get_airwheel():
+  return default_device().get_airwheel()
 
-def move():
-  def register(handler):
-    global _on_move
-    _on_move = handler
-  return register
+def flick(*args, **kwargs):
+  return default_device().flick(*args, **kwargs)
+
+def circle(*args, **kwargs):
+  return default_device().circle(*args, **kwargs)
+
+def touch(*args, **kwargs):
+  return default_device().touch(*args, **kwargs)
+
+def tap(*args, **kwargs):
+  return default_device().tap(*args, **kwargs)
+
+def double_tap(*args, **kwargs):
+  return default_device().double_tap(*args, **kwargs)
+
+def garbage(weak=False, details=False):
+  return default_device().garbage(weak, details)
+
+def move(weak=False):
+  return default_device().move(weak)
+
+def airwheel(weak=False):
+  return default_device().airwheel(weak)
 
-def airwheel():
-  def register(handler):
-    global _on_airwheel
-    _on_airwheel = handler
-  return register
+def subscribe(kind, handler, position=None, weak=False, details=False):
+  default_device().subscribe(kind, handler, position, weak, details)
+
+def unsubscribe(handler, kind=None, position=None):
+  return default_device().unsubscribe(handler, kind, position)
+
+def use_backend(bus, gpio):
+  default_device().use_backend(bus, gpio)
 
 def _exit():
-  stop_poll()
-  if GPIO != None:
-    GPIO.cleanup()
+  for device in list(_opened):
+    device.close()
 
 atexit.register(_exit)
-
-reset()
-i2c.write_i2c_block_data(SW_ADDR, 0xa1, [0b00000000, 0b00011111, 0b00000000, 0b00011111])
-start_poll()
@@ -0,0 +1,75 @@
+'''
+Capturing raw messages and replaying them through ReplayMGC3130
+
+Run from the repository root:
+
+  python -m pytest -q tests
+'''
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import skywriter
+
+def open_device(backend):
+  '''
+  An open device on backend, with the positions it moves to
+  '''
+  device = skywriter.Skywriter(bus=backend, gpio=backend)
+  device.autostart = False
+  device.threaded_dispatch = False
+  moves = []
+  device.subscribe('move', lambda x, y, z: moves.append((x, y, z)))
+  device.open()
+  return device, moves
+
+def test_capture_and_replay_round_trip(tmpdir):
+  path = str(tmpdir.join('session.skyw'))
+
+  sim = skywriter.SimulatedMGC3130(rate=0, seed=1)
+  device, recorded = open_device(sim)
+  device.start_capture(path)
+  for i in range(50):
+    assert device._wait_for_transfer()
+    device._read()
+  device.close()
+  assert len(recorded) >= 40
+
+  capture = skywriter.CaptureFile(path)
+  assert len(capture) == 50
+  timestamps = [capture.timestamp(i) for i in range(len(capture))]
+  assert timestamps == sorted(timestamps)
+  assert capture.find(timestamps[10]) == 10
+  assert capture[-1][1][3] == skywriter.SW_SENSOR_DATA
+
+  replay = skywriter.ReplayMGC3130(capture, realtime=False)
+  device, replayed = open_device(replay)
+  # The line stays high once the capture and the replies to open() are read
+  while device._wait_for_transfer():
+    device._read()
+  device.close()
+
+  assert replay.finished
+  assert replayed == recorded
+  assert device.get_stats()['frames_dropped'] == 0
+  capture.close()
+
+def test_partial_record_is_cut_off(tmpdir):
+  path = str(tmpdir.join('partial.skyw'))
+  writer = skywriter.CaptureWriter(path)
+  for i in range(3):
+    writer.write(float(i), [12, 0, i, skywriter.SW_SENSOR_DATA, 0, 0, i, 0x80, 0, 0, 0, 0])
+  writer.close()
+  with open(path, 'ab') as f:
+    f.write(b'\0' * 10)
+
+  # Appending drops the half-written record rather than misaligning the rest
+  writer = skywriter.CaptureWriter(path)
+  writer.write(3.0, [12, 0, 3, skywriter.SW_SENSOR_DATA, 0, 0, 3, 0x80, 0, 0, 0, 0])
+  writer.close()
+
+  capture = skywriter.CaptureFile(path)
+  assert len(capture) == 4
+  assert [capture[i][0] for i in range(4)] == [0.0, 1.0, 2.0, 3.0]
+  assert [capture[i][1][2] for i in range(4)] == [0, 1, 2, 3]
+  capture.close()
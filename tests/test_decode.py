@@ -0,0 +1,171 @@
+'''
+Sensor data decoding, gestures, touches and the airwheel
+
+Messages are built by hand and fed to handle_message() on a
+device that is never opened, so nothing here needs a bus.
+
+Run from the repository root:
+
+  python -m pytest -q tests
+'''
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pytest
+
+import skywriter
+
+POSITION_VALID = 0b00000001
+AIRWHEEL_VALID = 0b00000010
+DSP_RUNNING    = 0b10000000
+
+def sensor_message(seq=0, counter=0, sysinfo=DSP_RUNNING, gesture=None, touch=None, airwheel=None, xyz=None):
+  '''
+  A sensor data (0x91) message with the fields that are given
+  '''
+  fields = {
+    skywriter.SW_DATA_GESTURE:  gesture,
+    skywriter.SW_DATA_TOUCH:    touch,
+    skywriter.SW_DATA_AIRWHEEL: airwheel,
+    skywriter.SW_DATA_XYZ:      xyz
+  }
+  mask = 0
+  payload = []
+  for bit, size in skywriter._SENSOR_FIELDS:
+    value = fields.get(bit)
+    if value == None:
+      continue
+    mask |= bit
+    if bit == skywriter.SW_DATA_XYZ:
+      value = [byte for axis in value for byte in (axis & 0xff, axis >> 8)]
+    payload += list(value) + [0] * (size - len(value))
+  payload = [mask & 0xff, mask >> 8, counter, sysinfo] + payload
+  return [skywriter.SW_HEADER_SIZE + len(payload), 0, seq, skywriter.SW_SENSOR_DATA] + payload
+
+def touch_bytes(action, count=0):
+  return [action & 0xff, action >> 8, count]
+
+@pytest.fixture
+def device():
+  device = skywriter.Skywriter(bus=object(), gpio=object())
+  device.autostart = False
+  device.threaded_dispatch = False
+  return device
+
+def test_position(device):
+  moves = []
+  device.subscribe('move', lambda x, y, z: moves.append((x, y, z)))
+
+  device.handle_message(sensor_message(sysinfo=DSP_RUNNING | POSITION_VALID,
+                                       xyz=(0x8000, 0x4000, 0xc000)), 10.0)
+  assert moves == [(0.5, 0.25, 0.75)]
+  assert device.get_latest() == (0.5, 0.25, 0.75, 10.0, 1)
+
+  # Without PositionValid the position is ignored
+  device.handle_message(sensor_message(seq=1, xyz=(0, 0, 0)), 11.0)
+  assert len(moves) == 1
+  assert device.get_stats()['sensor_frames'] == 2
+
+def test_layout_changes_between_messages(device):
+  moves = []
+  device.subscribe('move', lambda x, y, z: moves.append((x, y, z)))
+
+  device.handle_message(sensor_message(seq=0, sysinfo=DSP_RUNNING | POSITION_VALID,
+                                       xyz=(0, 0, 0x8000)))
+  device.handle_message(sensor_message(seq=1, sysinfo=DSP_RUNNING | POSITION_VALID,
+                                       gesture=[0, 0, 0, 0], touch=touch_bytes(0),
+                                       airwheel=[0], xyz=(0x8000, 0, 0)))
+  device.handle_message(sensor_message(seq=2, sysinfo=DSP_RUNNING | POSITION_VALID,
+                                       xyz=(0, 0x8000, 0)))
+  assert moves == [(0.0, 0.0, 0.5), (0.5, 0.0, 0.0), (0.0, 0.5, 0.0)]
+  assert device.get_stats()['frames_dropped'] == 0
+
+def test_truncated_message_is_discarded(device):
+  moves = []
+  device.subscribe('move', lambda x, y, z: moves.append((x, y, z)))
+
+  msg = sensor_message(sysinfo=DSP_RUNNING | POSITION_VALID, xyz=(1, 2, 3))
+  device.handle_message(msg[:-2])
+  assert moves == []
+  assert device.get_stats()['truncated'] == 1
+
+def test_flick_edge_flag_from_third_gesture_byte(device):
+  flicks = []
+  device.subscribe('flick', lambda *args: flicks.append(args), details=True)
+
+  # Gesture 3 is an east to west flick, edge flick is bit 0 of the third byte
+  device.handle_message(sensor_message(seq=0, gesture=[3, 0x00, 0x01, 0]), 20.0)
+  # A set bit 0 in the classification byte is not an edge flick
+  device.handle_message(sensor_message(seq=1, gesture=[3, 0x01, 0x00, 0]), 21.0)
+  assert flicks == [('east', 'west', True, 20.0), ('east', 'west', False, 21.0)]
+
+def test_gesture_handlers_get_directions_unless_details(device):
+  flicks, circles = [], []
+  device.subscribe('flick', lambda start, finish: flicks.append((start, finish)))
+  device.subscribe('circle', lambda direction: circles.append(direction))
+
+  device.handle_message(sensor_message(seq=0, gesture=[4, 0, 1, 0]))
+  device.handle_message(sensor_message(seq=1, gesture=[7, 0, 0, 0]))
+  device.handle_message(sensor_message(seq=2, gesture=[0, 0, 0, 0]))
+  assert flicks == [('south', 'north')]
+  assert circles == ['counter-clockwise']
+
+@pytest.mark.parametrize('bit', range(len(skywriter.TOUCH_ACTIONS)))
+def test_touch_action_for_each_bit(device, bit):
+  events = []
+  kind, position = skywriter.TOUCH_ACTIONS[bit]
+  device.subscribe(kind, lambda where: events.append((kind, where)))
+
+  device.handle_message(sensor_message(touch=touch_bytes(1 << bit)))
+  assert events == [(kind, position)]
+
+def test_touch_highest_action_wins(device):
+  events = []
+  for kind in ('touch', 'tap', 'doubletap'):
+    device.subscribe(kind, lambda where, kind=kind: events.append((kind, where)))
+  centre = []
+  device.subscribe('tap', lambda: centre.append(True), position='center')
+
+  # touch south, tap center and doubletap west, only the doubletap is reported
+  device.handle_message(sensor_message(seq=0, touch=touch_bytes(1 << 0 | 1 << 9 | 1 << 11)))
+  device.handle_message(sensor_message(seq=1, touch=touch_bytes(1 << 9)))
+  assert events == [('doubletap', 'west'), ('tap', 'center')]
+  assert centre == [True]
+
+  # Bits above the touch actions are ignored
+  device.handle_message(sensor_message(seq=2, touch=touch_bytes(1 << 15)))
+  assert len(events) == 2
+
+def test_airwheel_unwraps_across_zero():
+  wheel = skywriter.AirWheel()
+  step = 360.0 / skywriter.SW_AIRWHEEL_STEPS
+
+  assert wheel.update(250, 0, 0.0) == 0.0
+  assert wheel.update(2, 1, 0.005) == 8 * step
+  assert wheel.update(250, 2, 0.010) == -8 * step
+  assert wheel.update(255, 3, 0.015) == 5 * step
+  assert wheel.update(0, 4, 0.020) == step
+  assert wheel.state[0] == 6 * step
+  assert wheel.state[1] > 0.0
+
+  wheel.stop(0.025)
+  assert wheel.state == (6 * step, 0.0, 0.025)
+  # The next active frame only sets a new reference
+  assert wheel.update(100, 5, 0.030) == 0.0
+  assert wheel.state[0] == 6 * step
+
+def test_airwheel_events(device):
+  deltas = []
+  device.subscribe('airwheel', lambda delta: deltas.append(delta))
+  step = 360.0 / skywriter.SW_AIRWHEEL_STEPS
+  sysinfo = DSP_RUNNING | AIRWHEEL_VALID
+
+  for seq, counter in enumerate((254, 255, 1, 1, 0)):
+    device.handle_message(sensor_message(seq=seq, counter=seq, sysinfo=sysinfo, airwheel=[counter]))
+  assert deltas == [step, 2 * step, -step]
+  assert device.get_airwheel()[0] == 2 * step
+
+  # Without AirWheelValid the wheel stops
+  device.handle_message(sensor_message(seq=5, counter=5, airwheel=[0]))
+  assert device.get_airwheel()[1] == 0.0
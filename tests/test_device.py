@@ -0,0 +1,66 @@
+'''
+Opening and configuring a Skywriter against SimulatedMGC3130
+
+Run from the repository root:
+
+  python -m pytest -q tests
+'''
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import skywriter
+
+def wait_for(condition, timeout=10.0):
+  '''
+  Poll condition until it is true or timeout seconds pass
+  '''
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    if condition():
+      return True
+    time.sleep(0.01)
+  return condition()
+
+class Midway(skywriter.SimulatedMGC3130):
+  '''
+  Runs during() once, after the first write while the device is
+  being configured
+  '''
+  during = None
+
+  def write_i2c_block_data(self, addr, cmd, data):
+    skywriter.SimulatedMGC3130.write_i2c_block_data(self, addr, cmd, data)
+    during, self.during = self.during, None
+    if during != None:
+      during()
+
+def test_runtime_parameter_set_during_reset():
+  sim = skywriter.SimulatedMGC3130(rate=200)
+  device = skywriter.Skywriter(bus=sim, gpio=sim, scheduler=skywriter.Scheduler())
+  device.threaded_dispatch = False
+  device.start()
+  try:
+    device.set_airwheel_detection(True)
+    assert wait_for(lambda: sim.runtime.get(skywriter.SW_PARAM_AIRWHEEL) == (0x20, 0x20))
+  finally:
+    device.close()
+
+def test_settings_made_while_configuring_reach_the_chip():
+  sim = Midway(rate=200)
+  device = skywriter.Skywriter(bus=sim, gpio=sim, scheduler=skywriter.Scheduler())
+  device.threaded_dispatch = False
+  device.auto_mask = True
+
+  def during():
+    device.subscribe('move', lambda x, y, z: None)
+    device.set_airwheel_detection(True)
+  sim.during = during
+
+  device.open()
+  try:
+    assert sim.output_mask & skywriter.SW_DATA_XYZ
+    assert device.get_output_mask() & skywriter.SW_DATA_XYZ
+    assert sim.runtime.get(skywriter.SW_PARAM_AIRWHEEL) == (0x20, 0x20)
+  finally:
+    device.close()
@@ -0,0 +1,86 @@
+'''
+EventQueue coalescing and overflow
+
+Run from the repository root:
+
+  python -m pytest -q tests
+'''
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pytest
+
+import skywriter
+
+def event(kind, args=(), device='left'):
+  return skywriter.Event(kind, args, 0.0, device)
+
+def drain(queue):
+  events = []
+  while True:
+    item = queue.get_nowait()
+    if item == None:
+      return events
+    events.append((item.kind, item.args, item.device))
+
+def test_moves_coalesce_per_device():
+  queue = skywriter.EventQueue(maxsize=8)
+  queue.put(event('move', (1,)))
+  queue.put(event('tap', ('north',)))
+  queue.put(event('move', (2,)))
+  queue.put(event('move', (3,), device='right'))
+  queue.put(event('move', (4,)))
+
+  # The latest move keeps the place of the first one it replaced
+  assert drain(queue) == [('move', (4,), 'left'), ('tap', ('north',), 'left'),
+                          ('move', (3,), 'right')]
+  assert queue.dropped == 0
+
+  # Once taken, the next move queues afresh
+  queue.put(event('move', (5,)))
+  assert drain(queue) == [('move', (5,), 'left')]
+
+def test_other_kinds_do_not_coalesce():
+  queue = skywriter.EventQueue(maxsize=8)
+  for position in ('north', 'south', 'north'):
+    queue.put(event('tap', (position,)))
+  assert [args for kind, args, device in drain(queue)] == [('north',), ('south',), ('north',)]
+
+def test_overflow_drops_oldest():
+  queue = skywriter.EventQueue(maxsize=3)
+  queue.put(event('move', (0,)))
+  for i in range(1, 5):
+    queue.put(event('tap', (i,)))
+
+  assert drain(queue) == [('tap', (2,), 'left'), ('tap', (3,), 'left'), ('tap', (4,), 'left')]
+  assert queue.dropped == 2
+
+  # The dropped move no longer takes replacements
+  queue.put(event('move', (5,)))
+  queue.put(event('move', (6,)))
+  assert drain(queue) == [('move', (6,), 'left')]
+
+def test_overflow_drops_newest():
+  queue = skywriter.EventQueue(maxsize=2, overflow='drop-newest')
+  for i in range(4):
+    queue.put(event('tap', (i,)))
+  assert [args for kind, args, device in drain(queue)] == [(0,), (1,)]
+  assert queue.dropped == 2
+
+def test_full_queue_still_coalesces():
+  queue = skywriter.EventQueue(maxsize=2, overflow='drop-newest')
+  queue.put(event('move', (1,)))
+  queue.put(event('tap', ('north',)))
+  queue.put(event('move', (2,)))
+  assert drain(queue) == [('move', (2,), 'left'), ('tap', ('north',), 'left')]
+  assert queue.dropped == 0
+
+def test_bad_overflow():
+  with pytest.raises(ValueError):
+    skywriter.EventQueue(overflow='block')
+
+def test_get_times_out():
+  queue = skywriter.EventQueue()
+  assert queue.get(0.01) == None
+  assert len(queue) == 0
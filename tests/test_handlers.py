@@ -0,0 +1,49 @@
+'''
+HandlerRegistry subscriptions and weak handlers
+
+Run from the repository root:
+
+  python -m pytest -q tests
+'''
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import skywriter
+
+class Overlay(object):
+  def __init__(self):
+    self.moves = []
+
+  def on_move(self, x, y, z):
+    self.moves.append((x, y, z))
+
+def test_weak_handler_collected_while_lock_is_held():
+  changes = []
+  registry = skywriter.HandlerRegistry(lambda: changes.append(registry.kinds()))
+  overlay = Overlay()
+  registry.subscribe('move', overlay.on_move, weak=True)
+  assert registry.kinds() == set(['move'])
+
+  # Collection can interrupt a thread holding the lock, it must not wait on it
+  with registry._lock:
+    del overlay
+  assert registry.dirty
+
+  registry.collect()
+  assert not registry.dirty
+  assert registry.routes == {}
+  assert changes[-1] == set()
+
+def test_weak_handler_dropped_by_next_subscribe():
+  registry = skywriter.HandlerRegistry()
+  overlay = Overlay()
+  registry.subscribe('move', overlay.on_move, weak=True)
+  for handler, arity in registry.routes['move']:
+    handler(0.5, 0.5, 0.5)
+  assert overlay.moves == [(0.5, 0.5, 0.5)]
+
+  del overlay
+  registry.subscribe('tap', lambda position: None)
+  assert 'move' not in registry.routes
+  assert registry.kinds() == set(['tap'])
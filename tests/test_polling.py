@@ -0,0 +1,92 @@
+'''
+TS edge waits and polling against SimulatedMGC3130
+
+Run from the repository root:
+
+  python -m pytest -q tests
+'''
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import skywriter
+
+class LateEdge(skywriter.SimulatedMGC3130):
+  '''
+  TS drops just after the poller has read it high
+  '''
+  def __init__(self):
+    skywriter.SimulatedMGC3130.__init__(self, rate=0)
+    self.level = self.HIGH
+    self.callback = None
+
+  def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+    self.callback = callback
+
+  def remove_event_detect(self, pin):
+    self.callback = None
+
+  def wait_for_edge(self, pin, edge, timeout=None):
+    # The edge has been and gone, so only the timeout ends this
+    time.sleep(timeout / 1000.0)
+
+  def input(self, pin):
+    level, self.level = self.level, self.LOW
+    if level == self.HIGH:
+      self.callback(pin)
+    return level
+
+def test_edge_between_check_and_wait_is_not_lost():
+  gpio = LateEdge()
+  device = skywriter.Skywriter(bus=gpio, gpio=gpio)
+  device._watch_transfer()
+  assert device._watching
+
+  start = time.time()
+  assert device._wait_for_transfer()
+  assert time.time() - start < skywriter.SW_XFER_TIMEOUT / 1000.0 / 2
+
+def test_reads_keep_up_with_edges():
+  sim = skywriter.SimulatedMGC3130(rate=100)
+  device = skywriter.Skywriter(bus=sim, gpio=sim)
+  device.open()
+  try:
+    assert device._watching
+    start = time.time()
+    for i in range(50):
+      assert device._wait_for_transfer()
+      device._read()
+    # 50 frames at 100 per second, with no wait running to SW_XFER_TIMEOUT
+    assert time.time() - start < 0.5 + skywriter.SW_XFER_TIMEOUT / 1000.0
+  finally:
+    device.close()
+  assert not device._watching
+
+def test_shared_thread_sleeps_between_frames():
+  scheduler = skywriter.Scheduler()
+  passes = []
+  do_poll = scheduler._do_poll
+  def counted():
+    passes.append(1)
+    return do_poll()
+  scheduler._do_poll = counted
+
+  devices = []
+  for i in range(2):
+    sim = skywriter.SimulatedMGC3130(rate=20)
+    device = skywriter.Skywriter(bus=sim, gpio=sim, scheduler=scheduler)
+    device.threaded_dispatch = False
+    device.open()
+    devices.append(device)
+  try:
+    for device in devices:
+      device.start_poll()
+    time.sleep(1.0)
+  finally:
+    for device in devices:
+      device.close()
+
+  frames = sum(device.get_stats()['sensor_frames'] for device in devices)
+  assert frames > 20
+  # Woken by edges, about two passes a frame rather than one every SW_POLL_INTERVAL
+  assert len(passes) < 3 * frames + 20
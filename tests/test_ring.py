@@ -0,0 +1,75 @@
+'''
+SampleRing, RingReader and drain() wraparound
+
+Run from the repository root:
+
+  python -m pytest -q tests
+'''
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pytest
+
+import skywriter
+
+numpy = pytest.importorskip('numpy')
+
+def push(ring, count):
+  for i in range(count):
+    n = ring.count
+    ring.push(float(n), n & 0xff, 1, n / 1000.0, 0.0, 0.0, 0)
+
+def test_views_stay_contiguous_across_the_end():
+  ring = skywriter.SampleRing(capacity=4)
+  push(ring, 7)
+
+  view = ring.view(3, 7)
+  assert list(view['seq']) == [4, 5, 6, 7]
+  assert list(view['timestamp']) == [3.0, 4.0, 5.0, 6.0]
+  # A view, not a copy
+  assert view.base is ring.data or view.base is ring.data.base
+
+def test_reader_drains_only_new_samples():
+  ring = skywriter.SampleRing(capacity=4)
+  push(ring, 2)
+  reader = ring.reader()
+  assert len(reader.drain()) == 0
+
+  push(ring, 3)
+  assert list(reader.drain()['seq']) == [3, 4, 5]
+  push(ring, 3)
+  assert list(reader.drain()['seq']) == [6, 7, 8]
+  assert len(reader.drain()) == 0
+  assert reader.dropped == 0
+
+def test_reader_that_falls_behind_skips_the_oldest():
+  ring = skywriter.SampleRing(capacity=4)
+  reader = ring.reader()
+
+  push(ring, 11)
+  assert list(reader.drain()['seq']) == [8, 9, 10, 11]
+  assert reader.dropped == 7
+
+  push(ring, 1)
+  assert list(reader.drain()['seq']) == [12]
+  assert reader.dropped == 7
+
+def test_device_drain_records_decoded_frames():
+  device = skywriter.Skywriter(bus=object(), gpio=object())
+  device.autostart = False
+  ring = device.get_ring(capacity=8)
+  assert len(device.drain()) == 0
+
+  for seq in range(20):
+    x = seq * 1000
+    payload = [skywriter.SW_DATA_XYZ, 0, seq, 0b10000001, x & 0xff, x >> 8, 0, 0, 0, 0]
+    device.handle_message([skywriter.SW_HEADER_SIZE + len(payload), 0, seq, skywriter.SW_SENSOR_DATA] + payload,
+                          100.0 + seq)
+
+  samples = device.drain()
+  assert list(samples['counter']) == list(range(12, 20))
+  assert list(samples['timestamp']) == [100.0 + seq for seq in range(12, 20)]
+  assert numpy.allclose(samples['x'], [seq * 1000 / 65536.0 for seq in range(12, 20)])
+  assert ring.count == 20
+  assert device._ring_reader.dropped == 12
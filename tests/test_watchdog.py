@@ -0,0 +1,127 @@
+'''
+Watchdog recovery, backoff and recover() against SimulatedMGC3130
+
+Run from the repository root:
+
+  python -m pytest -q tests
+'''
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pytest
+
+import skywriter
+
+def wait_for(condition, timeout=10.0):
+  '''
+  Poll condition until it is true or timeout seconds pass
+  '''
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    if condition():
+      return True
+    time.sleep(0.01)
+  return condition()
+
+@pytest.fixture
+def device():
+  sim = skywriter.SimulatedMGC3130(rate=200)
+  device = skywriter.Skywriter(bus=sim, gpio=sim, scheduler=skywriter.Scheduler())
+  device.threaded_dispatch = False
+  device.auto_recover = True
+
+  watchdog = device.watchdog
+  watchdog.silence = 0.2
+  watchdog.dsp_timeout = 0.2
+  watchdog.delay = 0.01
+  watchdog.max_delay = 0.02
+  watchdog.attempts = 3
+
+  device.sim = sim
+  device.open()
+  device.start()
+  assert wait_for(lambda: device.get_stats()['sensor_frames'] > 0)
+  yield device
+  device.close()
+
+def test_recovers_from_a_fault_cleared_by_reset(device):
+  device.sim.inject_fault('silence', resets=1)
+
+  assert wait_for(lambda: device.watchdog.recoveries >= 1)
+  assert wait_for(lambda: device.watchdog.state == 'ok')
+  assert device.watchdog.faults.get('silence', 0) >= 1
+
+  frames = device.get_stats()['sensor_frames']
+  assert wait_for(lambda: device.get_stats()['sensor_frames'] > frames)
+
+def test_backoff_clears_once_healthy(device):
+  device.sim.inject_fault('dsp', resets=1)
+
+  assert wait_for(lambda: device.watchdog.recoveries >= 1)
+  assert device.watchdog.tries >= 1
+  # Reading with DSPRunning set for dsp_timeout starts the backoff over
+  assert wait_for(lambda: device.watchdog.tries == 0)
+  assert device.watchdog.state == 'ok'
+
+def test_persistent_dsp_fault_fails(device):
+  device.sim.inject_fault('dsp', resets=None)
+
+  assert wait_for(lambda: device.watchdog.state == 'failed')
+  assert device.watchdog.tries == device.watchdog.attempts
+  assert device.watchdog.faults['dsp'] > device.watchdog.attempts
+
+  # Given up, nothing is retried
+  recoveries = device.watchdog.recoveries
+  time.sleep(0.5)
+  assert device.watchdog.state == 'failed'
+  assert device.watchdog.recoveries == recoveries
+
+def test_backoff_doubles_up_to_max_delay():
+  watchdog = skywriter.Watchdog(delay=0.1, max_delay=0.3, attempts=4)
+
+  delays = []
+  while watchdog.backoff() != None:
+    delays.append(watchdog.backoff())
+    watchdog.tries += 1
+
+  assert delays == [0.1, 0.2, 0.3, 0.3]
+
+def test_manual_recover_after_failed(device):
+  device.sim.inject_fault('dsp', resets=None)
+  assert wait_for(lambda: device.watchdog.state == 'failed')
+
+  device.sim.clear_fault()
+  recoveries = device.watchdog.recoveries
+  device.recover()
+
+  assert wait_for(lambda: device.watchdog.recoveries > recoveries)
+  assert wait_for(lambda: device.watchdog.state == 'ok')
+  assert device.get_health()['dsp_running']
+
+  frames = device.get_stats()['sensor_frames']
+  assert wait_for(lambda: device.get_stats()['sensor_frames'] > frames)
+
+def test_manual_recover_retries_a_persistent_fault(device):
+  device.sim.inject_fault('dsp', resets=None)
+  assert wait_for(lambda: device.watchdog.state == 'failed')
+
+  # A hand-started recovery gets the full number of attempts again
+  faults = device.watchdog.faults['dsp']
+  device.recover()
+  assert device.watchdog.state == 'recovering'
+
+  assert wait_for(lambda: device.watchdog.state == 'failed')
+  assert device.watchdog.tries == device.watchdog.attempts
+  assert device.watchdog.faults['dsp'] >= faults + device.watchdog.attempts
+
+def test_silence_is_expected_with_approach_detection(device):
+  device.set_approach_detection(True)
+  device.sim.inject_fault('silence', resets=None)
+
+  time.sleep(1.0)
+  assert device.watchdog.state == 'ok'
+  assert device.watchdog.faults.get('silence', 0) == 0
+
+  device.set_approach_detection(False)
+  assert wait_for(lambda: device.watchdog.faults.get('silence', 0) >= 1)